@@ -0,0 +1,243 @@
+import asyncio
+import time
+from concurrent.futures import Future
+
+import zmq
+import zmq.asyncio
+
+from bsread.bsread import BIND, CONNECT, PULL, SUB
+from bsread.handlers.common import FrameReceiver, ReceivedMessage, Statistics
+from bsread.handlers.compact import Batch, Handler, Message
+from bsread.sender import Sender
+
+
+class AsyncSource:
+    """
+    Source for asyncio applications - messages are received with zmq.asyncio and decoded with the same handler as
+    Source. Many sources can be served by one event loop without receive timeouts and without a thread per source:
+
+        async with AsyncSource(host='ioc', port=9999) as source:
+            async for message in source:
+                print(message.data.pulse_id)
+
+    Only direct connections to a source are supported (no dispatching layer, no channel configuration).
+    """
+
+    def __init__(self, host, port=9999, conn_type=CONNECT, mode=PULL, queue_size=100, copy=True,
+                 decode_workers=None, projection=None, lazy=False, context=None):
+        """
+        :param host: Host of the source.
+        :param port: Data port of the source.
+        :param conn_type: CONNECT or BIND.
+        :param mode: PULL or SUB.
+        :param queue_size: High water mark of the socket.
+        :param copy: If False, frames are received without copying them out of zmq - see Source.
+        :param decode_workers: Number of threads to decode large channels in parallel - see Source.
+        :param projection: Channels to decode - see Source.
+        :param lazy: If True, channel values are only decoded when accessed for the first time.
+        :param context: zmq.asyncio.Context to use - the shared instance by default.
+        """
+        self.address = 'tcp://%s:%d' % (host, port)
+        self.conn_type = conn_type
+        self.mode = mode
+        self.queue_size = queue_size
+        self.copy = copy
+        self.context = context
+
+        self.socket = None
+        self.handler = Handler(decode_workers=decode_workers, projection=projection, lazy=lazy)
+        self.statistics = Statistics()
+
+        # Message that did not fit into the last batch (data header changed) - it starts the next batch.
+        self.pending_message = None
+
+    def connect(self):
+        context = self.context or zmq.asyncio.Context.instance()
+
+        self.socket = context.socket(self.mode)
+        self.socket.set_hwm(self.queue_size)
+
+        if self.mode == SUB:
+            self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+
+        if self.conn_type == BIND:
+            self.socket.bind(self.address)
+        else:
+            self.socket.connect(self.address)
+
+        return self
+
+    def disconnect(self):
+        try:
+            self.socket.close(linger=0)
+        finally:
+            self.handler.close()
+
+    async def _receive_frames(self):
+        # A message is only taken from the socket once it was received completely - cancelling does not lose it.
+        frames = await self.socket.recv_multipart(copy=self.copy)
+
+        n_bytes = sum(len(frame) for frame in frames)
+        self.statistics.messages_received += 1
+        self.statistics.bytes_received = n_bytes
+        self.statistics.total_bytes_received += n_bytes
+
+        return FrameReceiver(frames)
+
+    async def receive(self, filter=None, handler=None):
+        """
+        Receive the next message. Cancelling the receive (e.g. by asyncio.wait_for) does not lose a message.
+        :param filter: Function(message) - messages for which it does not return True are skipped.
+        :param handler: Handler function(receiver) to decode the message. Default is the handler of the source.
+        :return: Received message.
+        """
+        if not handler:
+            handler = self.handler.receive
+
+        # Message that ended the last batch comes first.
+        if self.pending_message is not None:
+            message = self.pending_message
+            self.pending_message = None
+        else:
+            message = ReceivedMessage(self.statistics, handler(await self._receive_frames()))
+
+        while filter and not filter(message):
+            message = ReceivedMessage(self.statistics, handler(await self._receive_frames()))
+
+        return message
+
+    async def receive_batch(self, n, timeout=None):
+        """
+        Receive up to n messages as one columnar batch - see Source.receive_batch.
+        :param n: Maximum number of messages in the batch.
+        :param timeout: Maximum time in seconds to wait for the batch to fill up. If None the call returns as soon as
+                        n messages are received.
+        :return: Batch holding between 1 and n messages, None if no message was received.
+        """
+        batch = Batch(n)
+
+        if self.pending_message is not None:
+            batch.setup(self.pending_message.data.hash, self.handler.get_projected_channels())
+            batch.add_message(self.pending_message.data)
+            self.pending_message = None
+
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while batch.size < n:
+            if deadline is None:
+                receiver = await self._receive_frames()
+            else:
+                try:
+                    receiver = await asyncio.wait_for(self._receive_frames(), max(deadline - time.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+
+            data = self.handler.receive_batch(receiver, batch)
+
+            # Data header changed - cut the batch.
+            if isinstance(data, Message):
+                self.pending_message = ReceivedMessage(self.statistics, data)
+                break
+
+        if batch.size == 0:
+            return None
+
+        batch.trim()
+        return batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.receive()
+
+    async def __aenter__(self):
+        return self.connect()
+
+    async def __aexit__(self, type, value, traceback):
+        self.disconnect()
+
+
+class AsyncSender:
+    """
+    Sender for asyncio applications - messages are created by a Sender and sent with zmq.asyncio. If the queue of
+    the socket is full, send waits (without blocking the event loop) until the receivers caught up. With block=False
+    messages that cannot be queued are dropped instead.
+
+        async with AsyncSender(port=9999) as sender:
+            await sender.send(data={"CHANNEL": 1.0})
+
+    All parameters are the same as for Sender. Concurrent sends get consecutive pulse_ids and are sent in this order.
+    """
+
+    def __init__(self, *args, context=None, **kwargs):
+        self.sender = Sender(*args, **kwargs)
+        self.context = context
+
+        self.socket = None
+        self.send_lock = asyncio.Lock()
+
+    @property
+    def pulse_id(self):
+        return self.sender.pulse_id
+
+    def add_channel(self, name, function=None, metadata=None):
+        self.sender.add_channel(name, function=function, metadata=metadata)
+
+    def tune_compression(self, *args, **kwargs):
+        self.sender.tune_compression(*args, **kwargs)
+
+    def open(self):
+        context = self.context or zmq.asyncio.Context.instance()
+
+        self.socket = context.socket(self.sender.mode)
+        self.socket.set_hwm(self.sender.queue_size)
+
+        if self.sender.send_timeout:
+            self.socket.setsockopt(zmq.SNDTIMEO, self.sender.send_timeout)
+
+        address = '%s:%d' % (self.sender.address, self.sender.port)
+        if self.sender.conn_type == BIND:
+            self.socket.bind(address)
+        else:
+            self.socket.connect(address)
+
+        self.sender._initialize_stream()
+
+    def close(self):
+        self.socket.close()
+        self.sender._close_stream()
+
+    async def send(self, *args, timestamp=None, pulse_id=None, data=None, check_data=True, **kwargs):
+        """
+        Send a message - see Sender.send.
+        """
+        with self.sender.channels_lock:
+            frames = self.sender._create_message_frames(args, timestamp, pulse_id, data, check_data, kwargs)
+            # Reserve the pulse_id before giving control back to the event loop.
+            self.sender.pulse_id += 1
+
+        # The lock is acquired in the order of the pulse_ids (no await since they were reserved).
+        async with self.send_lock:
+            # Values serialized on the thread pool are awaited without blocking the event loop.
+            frames = [await asyncio.wrap_future(frame) if isinstance(frame, Future) else frame for frame in frames]
+
+            if self.sender.block:
+                await self.socket.send_multipart(frames, copy=self.sender.copy)
+            else:
+                try:
+                    await self.socket.send_multipart(frames, zmq.NOBLOCK, copy=self.sender.copy)
+                except zmq.Again:
+                    # Same as Sender - in non blocking mode messages that cannot be sent are dropped.
+                    pass
+
+        # Call post function if registered
+        if self.sender.post_function:
+            self.sender.post_function()
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,189 @@
+import logging
+from collections import deque
+from threading import Condition, Thread
+
+_logger = logging.getLogger(__name__)
+
+# Overflow policies of the ring buffer.
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+BLOCK = "block"
+
+# Interval in seconds in which the receive thread checks whether it needs to stop.
+POLL_INTERVAL = 0.1
+
+
+class RingBuffer:
+    """
+    Bounded, thread safe FIFO buffer with a configurable overflow policy.
+    """
+
+    def __init__(self, size, overflow=DROP_OLDEST):
+        """
+        :param size: Maximum number of items in the buffer.
+        :param overflow: What to do if the buffer is full: DROP_OLDEST (replace the oldest item), DROP_NEWEST (discard
+                         the new item) or BLOCK (wait until there is space).
+        """
+        if overflow not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError("Overflow policy '%s' not supported. Available: %s" %
+                             (overflow, [DROP_OLDEST, DROP_NEWEST, BLOCK]))
+
+        self.size = size
+        self.overflow = overflow
+
+        self.items = deque()
+        self.condition = Condition()
+
+        self.dropped = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return len(self.items)
+
+    def put(self, item, timeout=None):
+        """
+        Add an item.
+        :param item: Item to add.
+        :param timeout: Maximum time in seconds to wait for space with the BLOCK policy.
+        :return: True if the item was added, False if it was dropped (or the wait timed out).
+        """
+        with self.condition:
+            if len(self.items) >= self.size:
+
+                if self.overflow == DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped += 1
+
+                elif self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+
+                elif not self.condition.wait_for(lambda: len(self.items) < self.size, timeout):
+                    return False
+
+            self.items.append(item)
+            self.max_depth = max(self.max_depth, len(self.items))
+
+            self.condition.notify_all()
+
+        return True
+
+    def get(self, timeout=None):
+        """
+        Take the oldest item.
+        :param timeout: Maximum time in seconds to wait for an item. None waits until an item is available.
+        :return: Oldest item, None if no item was available within the timeout.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.items, timeout):
+                return None
+
+            item = self.items.popleft()
+            self.condition.notify_all()
+
+        return item
+
+
+class BackgroundReceiver:
+    """
+    Receive and decode the messages of a source on a dedicated thread into a ring buffer - processing jitter of the
+    consumer does not stall the network receive (and fill up the zmq queue) anymore.
+
+        with source(host='ioc', port=9999) as stream:
+            with BackgroundReceiver(stream, buffer_size=1000) as receiver:
+                message = receiver.receive()
+    """
+
+    def __init__(self, source, buffer_size=100, overflow=DROP_OLDEST):
+        """
+        :param source: Connected source (Source) to receive from.
+        :param buffer_size: Maximum number of decoded messages in the buffer.
+        :param overflow: Policy if the buffer is full: DROP_OLDEST, DROP_NEWEST or BLOCK (stop receiving until the
+                         consumer caught up - messages then queue up in zmq).
+        """
+        self.source = source
+        self.buffer = RingBuffer(buffer_size, overflow)
+
+        self.messages_received = 0
+        self.error = None
+
+        self.running = False
+        self.thread = None
+
+    @property
+    def messages_dropped(self):
+        return self.buffer.dropped
+
+    @property
+    def queue_depth(self):
+        return self.buffer.depth
+
+    def start(self):
+        self.running = True
+        self.error = None
+
+        self.thread = Thread(target=self._receive_messages, name="bsread-receiver", daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.running = False
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _receive_messages(self):
+        socket = self.source.stream.socket
+
+        try:
+            while self.running:
+                # Wait with timeout - to be able to stop the thread.
+                if not socket.poll(int(POLL_INTERVAL * 1000)):
+                    continue
+
+                message = self.source.receive()
+                if message is None:
+                    continue
+
+                self.messages_received += 1
+
+                while self.running and not self.buffer.put(message, timeout=POLL_INTERVAL) and \
+                        self.buffer.overflow == BLOCK:
+                    pass
+
+        except Exception as e:
+            _logger.exception("Background receive failed.")
+            self.error = e
+            self.running = False
+
+    def receive(self, timeout=None):
+        """
+        Take the oldest received message from the buffer.
+        :param timeout: Maximum time in seconds to wait for a message. None waits until a message is available.
+        :return: Message, None if no message was available within the timeout.
+        """
+        while True:
+            # Without timeout, wait in intervals - to notice if the receive thread failed.
+            message = self.buffer.get(POLL_INTERVAL if timeout is None else timeout)
+
+            if message is not None:
+                return message
+
+            if self.error is not None:
+                raise RuntimeError("Background receive failed.") from self.error
+
+            if timeout is not None:
+                return None
+
+    def __iter__(self):
+        while True:
+            yield self.receive()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
@@ -1,7 +1,8 @@
 import mflow
 import json
+import time
 
-from bsread.handlers.compact import Handler
+from bsread.handlers.compact import Handler, Batch, Message
 
 
 PULL = mflow.PULL
@@ -20,12 +21,13 @@ class source:
     def __init__(self, host=None, port=9999, config_port=None, conn_type=CONNECT, mode=None, queue_size=100,
                  copy=True, channels=None, config_address=None, all_channels=False, receive_timeout=None,
                  dispatcher_url=DEFAULT_DISPATCHER_URL, dispatcher_verify_request=True,
-                 dispatcher_disable_compression=False):
+                 dispatcher_disable_compression=False, decode_workers=None, projection=None, lazy=False):
         self.source = Source(host=host, port=port, config_port=config_port, conn_type=conn_type, mode=mode,
                              queue_size=queue_size, copy=copy, channels=channels, config_address=config_address,
                              all_channels=all_channels, receive_timeout=receive_timeout, dispatcher_url=dispatcher_url,
                              dispatcher_verify_request=dispatcher_verify_request,
-                             dispatcher_disable_compression=dispatcher_disable_compression)
+                             dispatcher_disable_compression=dispatcher_disable_compression,
+                             decode_workers=decode_workers, projection=projection, lazy=lazy)
 
     def __enter__(self):
         self.source.connect()
@@ -40,7 +42,7 @@ class Source:
     def __init__(self, host=None, port=9999, config_port=None, conn_type=CONNECT, mode=None, queue_size=100,
                  copy=True, channels=None, config_address=None, all_channels=False, receive_timeout=None,
                  dispatcher_url=DEFAULT_DISPATCHER_URL, dispatcher_verify_request=True,
-                 dispatcher_disable_compression=False):
+                 dispatcher_disable_compression=False, decode_workers=None, projection=None, lazy=False):
         """
 
         Args:
@@ -52,6 +54,9 @@ class Source:
                             connect to the source or whether the source connects to this instance - values: CONNECT
                             or BIND
             mode:           Data delivery mode - values: PULL or PUB
+            copy:           If False, frames are received without copying them out of zmq. Array values are then
+                            read-only views on the received frames - use message.data.copy() (or value.copy()) to keep
+                            values beyond the next receive without holding on to the receive buffers.
             channels:       List of channels that should be in the stream. This is either a list of channel names and/or
                             a list of dictionaries specifying the desired channel configuration.
                             Example: ['ChannelA', {'name': 'ChannelC', 'modulo': 10},
@@ -65,6 +70,12 @@ class Source:
                             set.
             dispatcher_url: URL of the dispatcher api
             receive_timeout:Receive timeout in milliseconds (-1 infinite)
+            decode_workers: Number of threads used to decode (decompress) large channels of a message in parallel.
+                            None (default) decodes all channels on the receiving thread.
+            projection:     Channels to decode - list of channel names or function(channel_name) returning True for the
+                            channels to decode. Other channels are skipped without decoding them and are not part of
+                            the received messages. None (default) decodes all channels.
+            lazy:           If True, channel values are only decoded when accessed for the first time.
         """
 
         self.use_dispatching_layer = False
@@ -143,7 +154,10 @@ class Source:
             # make sure that the connect statement is issued very quick
 
         self.stream = None
-        self.handler = Handler()
+        self.handler = Handler(decode_workers=decode_workers, projection=projection, lazy=lazy)
+
+        # Message that did not fit into the last batch (data header changed) - it starts the next batch.
+        self.pending_message = None
 
     def connect(self):
         self.stream = mflow.connect(self.address, conn_type=self.conn_type, queue_size=self.queue_size, mode=self.mode,
@@ -153,6 +167,7 @@ class Source:
     def disconnect(self):
         try:
             self.stream.disconnect()
+            self.handler.close()
         finally:
             # # TODO REMOVE Workaround
             # import re
@@ -168,7 +183,12 @@ class Source:
         if not handler:
             handler = self.handler.receive
 
-        message = self.stream.receive(handler=handler)
+        # Message that ended the last batch comes first.
+        if self.pending_message is not None:
+            message = self.pending_message
+            self.pending_message = None
+        else:
+            message = self.stream.receive(handler=handler)
 
         if filter:
             while True:  # continue receiving new messages until condition is met
@@ -180,3 +200,50 @@ class Source:
             return message
 
 
+
+    def receive_batch(self, n, timeout=None):
+        """
+        Receive up to n messages as one columnar batch (see bsread.handlers.compact.Batch).
+
+        Args:
+            n:          Maximum number of messages in the batch.
+            timeout:    Maximum time in seconds to wait for the batch to fill up. If None the call returns as soon as n
+                        messages are received (or the receive_timeout of the source expired).
+
+        Returns: Batch holding between 1 and n messages, None if no message was received. If the data header changes
+                 the batch is cut before the message with the new header - this message starts the next batch.
+        """
+        batch = Batch(n)
+
+        if self.pending_message is not None:
+            batch.setup(self.pending_message.data.hash, self.handler.get_projected_channels())
+            batch.add_message(self.pending_message.data)
+            self.pending_message = None
+
+        deadline = time.time() + timeout if timeout is not None else None
+
+        def handler(receiver):
+            return self.handler.receive_batch(receiver, batch)
+
+        while batch.size < n:
+            if deadline is not None:
+                remaining_time = deadline - time.time()
+                if remaining_time <= 0 or not self.stream.socket.poll(int(remaining_time * 1000)):
+                    break
+
+            message = self.stream.receive(handler=handler)
+
+            # Receive timeout.
+            if message is None:
+                break
+
+            # Data header changed - cut the batch.
+            if isinstance(message.data, Message):
+                self.pending_message = message
+                break
+
+        if batch.size == 0:
+            return None
+
+        batch.trim()
+        return batch
@@ -1,15 +1,22 @@
 import struct
+import time
 
 import bitshuffle
 import numpy
 
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
 
 class NoCompression:
     @staticmethod
     def unpack_data(raw_string, dtype, shape=None):
         """
         Convert raw bytes into the specified numpy type.
-        :param raw_string: Raw bytes to convert.
+        The result is a read-only view on the raw bytes (no copy) and keeps them alive as long as it is referenced.
+        :param raw_string: Raw bytes (or any object supporting the buffer protocol, e.g. zmq.Frame) to convert.
         :param dtype: dtype to use for the result.
         :param shape: Shape of the result.
         :return: Numpy array of dtype and shape.
@@ -20,6 +27,9 @@ class NoCompression:
         if raw_data.size == 0:
             return None
 
+        # Views on zmq frames are writable - make sure nobody modifies the received message.
+        raw_data.flags.writeable = False
+
         # Do not reshape scalars.
         if shape is not None and shape != [1]:
             # Numpy is slowest dimension first, but bsread is fastest dimension first.
@@ -28,21 +38,98 @@ class NoCompression:
         return raw_data
 
     @staticmethod
-    def pack_data(numpy_array, dtype=None):
+    def pack_data(numpy_array, dtype=None, copy=True, block_size=None):
         """
         Convert numpy array to byte array.
         :param numpy_array: Numpy array to convert.
         :param dtype: Data type (Numpy).
-        :return: Bytes array of provided numpy array.
+        :param copy: If False, return the (C contiguous) array itself instead of a copy of its bytes.
+        :param block_size: Ignored. Here just to have a consistent interface.
+        :return: Bytes array of provided numpy array, or an object supporting the buffer protocol if copy is False.
         """
+        if not copy:
+            return numpy.ascontiguousarray(numpy_array)
+
         return numpy_array.tobytes()
 
 
+def unpack_header(raw_bytes, dtype, shape=None):
+    """
+    Parse the header (unpacked length, compression block size) of compressed raw bytes.
+    :param raw_bytes: Raw bytes to convert.
+    :param dtype: dtype of the result.
+    :param shape: Shape of the result.
+    :return: Tuple (compressed data, numpy shape, block size in number of elements), None if no data was transmitted.
+    """
+    # Interpret the bytes as a numpy array.
+    raw_data = numpy.frombuffer(raw_bytes, dtype=numpy.uint8)
+
+    # If the numpy array is empty, return it as such.
+    if raw_data.size == 0:
+        return None
+
+    # Uncompressed block size, big endian, int64 (long long)
+    unpacked_length = struct.unpack(">q", raw_data[0:8].tobytes())[0]
+
+    # Empty array was transmitted.
+    if unpacked_length == 0:
+        return None
+
+    # Type of the output array.
+    n_bytes_per_element = numpy.dtype(dtype).itemsize
+
+    # Either the unpacked length or the dtype is wrong.
+    if unpacked_length % n_bytes_per_element != 0:
+        raise ValueError("Invalid unpacked length or dtype for raw bytes.")
+
+    # How many bytes per element we use.
+    n_elements = int(unpacked_length / n_bytes_per_element)
+
+    # TODO: This is so ugly.. discuss if strings really need a shape [1].
+
+    # shape == [1] and n_elements > 1 is used for strings.
+    if shape is None or (shape == [1] and n_elements > 1):
+        shape = (n_elements,)
+
+    # Compression block size, big endian, int32 (int). Divide by number of bytes per element.
+    header_compression_block_size = struct.unpack(">i", raw_data[8:12].tobytes())[0]
+    compression_block_size = header_compression_block_size / n_bytes_per_element
+
+    # Numpy is slowest dimension first, but bsread is fastest dimension first.
+    shape = tuple(shape[::-1])
+
+    return raw_data[12:], shape, compression_block_size
+
+
+def pack_header(numpy_array, dtype, compression_block_size):
+    """
+    Create the header (unpacked length, compression block size) of compressed data.
+    :param numpy_array: Array to compress.
+    :param dtype: Data type (Numpy).
+    :param compression_block_size: Compression block size in number of elements.
+    :return: Header bytes.
+    """
+    # We multiply the compression block size by the n_bytes_per_element, because the HDF5 filter does so.
+    # https://github.com/kiyo-masui/bitshuffle/blob/04e58bd553304ec26e222654f1d9b6ff64e97d10/src/bshuf_h5filter.c#L167
+    header_compression_block_size = compression_block_size * numpy.dtype(dtype).itemsize
+
+    # Uncompressed block size, big endian, int64 (long long). Compression block size, big endian, int32 (int).
+    return struct.pack(">qi", numpy_array.nbytes, header_compression_block_size)
+
+
 class BitshuffleLZ4:
 
-    # numpy type definitions can be found at: http://docs.scipy.org/doc/numpy/reference/arrays.dtypes.html
     @staticmethod
-    def unpack_data(raw_bytes, dtype, shape=None):
+    def compress(numpy_array, block_size):
+        return bitshuffle.compress_lz4(numpy_array, block_size)
+
+    @staticmethod
+    def decompress(raw_data, shape, dtype, block_size):
+        return bitshuffle.decompress_lz4(raw_data, block_size=block_size, shape=shape, dtype=dtype)
+
+    # numpy type definitions can be found at: http://docs.scipy.org/doc/numpy/reference/arrays.dtypes.html
+    @classmethod
+    def unpack_data(cls, raw_bytes, dtype, shape=None):
         """
         Convert raw bytes into the specified numpy type.
         :param raw_bytes: Raw bytes to convert.
@@ -50,93 +137,147 @@ class BitshuffleLZ4:
         :param shape: Shape of the result.
         :return: Numpy array of dtype and shape.
         """
-        # Interpret the bytes as a numpy array.
-        raw_data = numpy.frombuffer(raw_bytes, dtype=numpy.uint8)
+        header = unpack_header(raw_bytes, dtype, shape)
 
-        # If the numpy array is empty, return it as such.
-        if raw_data.size == 0:
+        # No data transmitted.
+        if header is None:
             return None
 
-        # Uncompressed block size, big endian, int64 (long long)
-        unpacked_length = struct.unpack(">q", raw_data[0:8].tobytes())[0]
+        raw_data, shape, compression_block_size = header
 
-        # Empty array was transmitted.
-        if unpacked_length == 0:
-            return None
+        # Actual data.
+        return cls.decompress(raw_data, shape, numpy.dtype(dtype), compression_block_size)
 
-        # Type of the output array.
-        dtype = numpy.dtype(dtype)
-        n_bytes_per_element = dtype.itemsize
+    @classmethod
+    def pack_data(cls, numpy_array, dtype, copy=True, block_size=None):
+        """
+        Compress the provided numpy array.
+        :param numpy_array: Array to compress.
+        :param dtype: Data type (Numpy).
+        :param copy: Ignored - the compressed data is always a new buffer. Here just to have a consistent interface.
+        :param block_size: Compression block size in number of elements. None to use get_compression_block_size.
+        :return: Header (unpacked length, compression block size) + Compressed data
+        """
+        n_bytes_per_element = numpy.dtype(dtype).itemsize
+        compression_block_size = block_size or cls.get_compression_block_size(n_bytes_per_element)
 
-        # Either the unpacked length or the dtype is wrong.
-        if unpacked_length % n_bytes_per_element != 0:
-            raise ValueError("Invalid unpacked length or dtype for raw bytes.")
+        compressed_bytes = cls.compress(numpy_array, compression_block_size).tobytes()
 
-        # How many bytes per element we use.
-        n_elements = int(unpacked_length / n_bytes_per_element)
+        return pack_header(numpy_array, dtype, compression_block_size) + compressed_bytes
 
-        # TODO: This is so ugly.. discuss if strings really need a shape [1].
+    target_block_size = 8192
+    minimum_block_size = 128
+    block_size_multiplier = 8
 
-        # shape == [1] and n_elements > 1 is used for strings.
-        if shape is None or (shape == [1] and n_elements > 1):
-            shape = (n_elements,)
+    @classmethod
+    def get_compression_block_size(cls, n_bytes_per_element):
 
-        # Compression block size, big endian, int32 (int). Divide by number of bytes per element.
-        header_compression_block_size = struct.unpack(">i", raw_data[8:12].tobytes())[0]
-        n_bytes_per_element = numpy.dtype(dtype).itemsize
-        compression_block_size = header_compression_block_size / n_bytes_per_element
+        block_size = cls.target_block_size / n_bytes_per_element
 
-        # If shape is not provided use the original length.
-        if shape is None:
-            shape = (unpacked_length,)
+        # Make the target block size the closest multiple of block_size_multiplier.
+        block_size = (block_size // cls.block_size_multiplier) * cls.block_size_multiplier
 
-        # Numpy is slowest dimension first, but bsread is fastest dimension first.
-        shape = shape[::-1]
+        # Since it is a multiple of block_size_multiplier (which is an int) it is always an int.
+        block_size = int(block_size)
 
-        # Actual data.
-        byte_array = bitshuffle.decompress_lz4(raw_data[12:], block_size=compression_block_size,
-                                               shape=shape, dtype=dtype)
+        return max(block_size, cls.minimum_block_size)
 
-        return byte_array
+    # Target block sizes (in bytes) tried when tuning the compression block size.
+    tuning_target_block_sizes = [2048, 4096, 8192, 16384, 32768, 65536]
 
-    @staticmethod
-    def pack_data(numpy_array, dtype):
+    @classmethod
+    def tune_compression_block_size(cls, numpy_array, n_repeats=3, size_tolerance=0.02):
         """
-        Compress the provided numpy array.
-        :param numpy_array: Array to compress.
-        :param dtype: Data type (Numpy).
-        :return: Header (unpacked length, compression block size) + Compressed data
+        Compress the array with different block sizes and pick the best one: the fastest of the block sizes that
+        compress to at most size_tolerance more than the smallest result.
+        :param numpy_array: Representative data to compress.
+        :param n_repeats: Number of times each block size is timed (the fastest time is used).
+        :param size_tolerance: Relative compressed size difference that is traded for speed.
+        :return: Tuple (block size in number of elements, compression ratio with this block size).
         """
-        # Uncompressed block size, big endian, int64 (long long)
-        unpacked_length_bytes = struct.pack(">q", numpy_array.nbytes)
+        n_bytes_per_element = numpy_array.dtype.itemsize
 
-        n_bytes_per_element = numpy.dtype(dtype).itemsize
-        compression_block_size = BitshuffleLZ4.get_compression_block_size(n_bytes_per_element)
+        block_sizes = set()
+        for target_block_size in cls.tuning_target_block_sizes:
+            block_size = (target_block_size // n_bytes_per_element // cls.block_size_multiplier) * \
+                cls.block_size_multiplier
+            block_sizes.add(max(block_size, cls.minimum_block_size))
 
-        # We multiply the compression block size by the n_bytes_per_element, because the HDF5 filter does so.
-        # https://github.com/kiyo-masui/bitshuffle/blob/04e58bd553304ec26e222654f1d9b6ff64e97d10/src/bshuf_h5filter.c#L167
-        header_compression_block_size = compression_block_size * n_bytes_per_element
-        # Compression block size, big endian, int32 (int).
-        block_size_bytes = struct.pack(">i", header_compression_block_size)
+        # List of (block_size, compressed_size, duration).
+        results = []
+        for block_size in sorted(block_sizes):
+            durations = []
+            for _ in range(n_repeats):
+                start_time = time.perf_counter()
+                compressed_size = cls.compress(numpy_array, block_size).nbytes
+                durations.append(time.perf_counter() - start_time)
 
-        compressed_bytes = bitshuffle.compress_lz4(numpy_array, compression_block_size).tobytes()
+            results.append((block_size, compressed_size, min(durations)))
 
-        return unpacked_length_bytes + block_size_bytes + compressed_bytes
+        smallest_size = min(compressed_size for _, compressed_size, _ in results)
+        block_size, compressed_size, _ = min((result for result in results
+                                              if result[1] <= smallest_size * (1 + size_tolerance)),
+                                             key=lambda result: result[2])
 
-    target_block_size = 8192
-    minimum_block_size = 128
-    block_size_multiplier = 8
+        return block_size, numpy_array.nbytes / max(compressed_size, 1)
+
+
+class BitshuffleZstd(BitshuffleLZ4):
+    """
+    Bitshuffle with zstd compression. Same header as bitshuffle_lz4 - better compression ratio, more CPU.
+    Only available if bitshuffle was built with zstd support.
+    """
+
+    # zstd compression level used by the sender.
+    compression_level = 3
 
     @staticmethod
-    def get_compression_block_size(n_bytes_per_element):
+    def compress(numpy_array, block_size):
+        return bitshuffle.compress_zstd(numpy_array, block_size, BitshuffleZstd.compression_level)
 
-        block_size = BitshuffleLZ4.target_block_size / n_bytes_per_element
+    @staticmethod
+    def decompress(raw_data, shape, dtype, block_size):
+        return bitshuffle.decompress_zstd(raw_data, shape=shape, dtype=dtype, block_size=block_size)
 
-        # Make the target block size the closest multiple of block_size_multiplier.
-        block_size = (block_size // BitshuffleLZ4.block_size_multiplier) * BitshuffleLZ4.block_size_multiplier
 
-        # Since it is a multiple of block_size_multiplier (which is an int) it is always an int.
-        block_size = int(block_size)
+class LZ4:
+    """
+    Plain LZ4 block compression (without bitshuffle), with the same header as bitshuffle_lz4. The data is compressed
+    as a single block - the block size in the header is 0. Requires the lz4 package.
+    """
 
-        return max(block_size, BitshuffleLZ4.minimum_block_size)
+    @staticmethod
+    def unpack_data(raw_bytes, dtype, shape=None):
+        """
+        Convert raw bytes into the specified numpy type.
+        :param raw_bytes: Raw bytes to convert.
+        :param dtype: dtype to use for the result.
+        :param shape: Shape of the result.
+        :return: Numpy array of dtype and shape.
+        """
+        header = unpack_header(raw_bytes, dtype, shape)
+
+        # No data transmitted.
+        if header is None:
+            return None
+
+        raw_data, shape, _ = header
+        dtype = numpy.dtype(dtype)
+
+        unpacked_bytes = lz4.block.decompress(raw_data, uncompressed_size=int(numpy.prod(shape)) * dtype.itemsize)
+
+        return numpy.frombuffer(unpacked_bytes, dtype=dtype).reshape(shape)
+
+    @staticmethod
+    def pack_data(numpy_array, dtype, copy=True, block_size=None):
+        """
+        Compress the provided numpy array.
+        :param numpy_array: Array to compress.
+        :param dtype: Data type (Numpy).
+        :param copy: Ignored - the compressed data is always a new buffer. Here just to have a consistent interface.
+        :param block_size: Ignored - the array is compressed as one block.
+        :return: Header (unpacked length, compression block size) + Compressed data
+        """
+        numpy_array = numpy.ascontiguousarray(numpy_array)
 
+        return pack_header(numpy_array, dtype, 0) + lz4.block.compress(numpy_array, store_size=False)
@@ -1,15 +1,20 @@
+import struct
 import traceback
 from logging import getLogger
 
 import numpy
 import sys
 
-from bsread.data.serialization import channel_type_deserializer_mapping, \
+from bsread.data.compression import NoCompression
+from bsread.data.serialization import deserialize_number, deserialize_string, channel_type_deserializer_mapping, \
     compression_provider_mapping, channel_type_scalar_serializer_mapping
 
 
 _logger = getLogger(__name__)
 
+# Compression ratio (uncompressed/compressed size) below which channel compression is not worth the CPU time.
+DEFAULT_MIN_COMPRESSION_RATIO = 1.1
+
 
 def get_channel_encoding(value):
     """
@@ -139,7 +144,8 @@ def get_value_reader(channel_type, compression, shape=None, endianness="", value
         # If the channel compression is not supported, always return None.
         return lambda x: None
 
-    decompressor = compression_provider_mapping[compression].unpack_data
+    compression_provider = compression_provider_mapping[compression]
+    decompressor = compression_provider.unpack_data
     dtype, serializer = channel_type_deserializer_mapping[channel_type]
     # Expand the dtype with the correct endianess.
     dtype = endianness + dtype
@@ -163,9 +169,71 @@ def get_value_reader(channel_type, compression, shape=None, endianness="", value
                          value_name, channel_type, shape, compression, len(raw_data), raw_data, e)
             return None
 
+    # Specialized readers for uncompressed scalars and strings - the generic reader remains for all other cases.
+    if compression_provider is NoCompression and (shape is None or shape == [1]):
+        if serializer is deserialize_number:
+            return get_scalar_reader(dtype, value_reader)
+        elif serializer is deserialize_string:
+            return get_string_reader(value_reader)
+
     return value_reader
 
 
+# Numpy (kind, itemsize) to struct format character (standard sizes).
+numpy_struct_format_mapping = {
+    ('i', 1): 'b', ('u', 1): 'B',
+    ('i', 2): 'h', ('u', 2): 'H',
+    ('i', 4): 'i', ('u', 4): 'I',
+    ('i', 8): 'q', ('u', 8): 'Q',
+    ('f', 4): 'f', ('f', 8): 'd'
+}
+
+
+def get_scalar_reader(dtype, fallback_reader):
+    """
+    Get a reader for uncompressed scalars that unpacks the value with struct instead of going through numpy arrays.
+    :param dtype: Numpy dtype (including endianness) of the scalar.
+    :param fallback_reader: Reader to use if the raw data is not a single scalar.
+    :return: Value reader returning numpy scalars of dtype (same as the generic reader).
+    """
+    dtype = numpy.dtype(dtype)
+
+    struct_format = numpy_struct_format_mapping.get((dtype.kind, dtype.itemsize))
+    if struct_format is None:
+        return fallback_reader
+
+    unpack = struct.Struct(('>' if dtype.str[0] == '>' else '<') + struct_format).unpack
+    scalar_type = dtype.type
+    size = dtype.itemsize
+
+    def scalar_reader(raw_data):
+        if len(raw_data) == size:
+            return scalar_type(unpack(raw_data)[0])
+
+        # Empty or malformed data (or waveforms without shape information).
+        return fallback_reader(raw_data)
+
+    return scalar_reader
+
+
+def get_string_reader(fallback_reader):
+    """
+    Get a reader for uncompressed (UTF-8) strings that decodes the raw data directly.
+    :param fallback_reader: Reader to use if the raw data cannot be decoded - takes care of the error handling.
+    :return: Value reader.
+    """
+    def string_reader(raw_data):
+        if raw_data:
+            try:
+                return str(raw_data, "utf-8")
+            except (TypeError, UnicodeDecodeError):
+                return fallback_reader(raw_data)
+
+        return None
+
+    return string_reader
+
+
 def get_value_bytes(value, compression=None, channel_type=None):
     """
     Based on the value, get the compressed bytes.
@@ -174,7 +242,20 @@ def get_value_bytes(value, compression=None, channel_type=None):
     :param channel_type: dtype to use for channel serialization. If not specified, derive from value.
     :return: Bytes ready to be sent over the channel.
     """
+    return get_value_serializer(value, compression, channel_type)(value)
+
 
+def get_value_serializer(value, compression=None, channel_type=None, copy=True, block_size=None):
+    """
+    Get a function that serializes and compresses values with the same signature (see get_value_signature) as the
+    provided value. The result is the same as get_value_bytes, but the value specs are only determined once.
+    :param value: Example value to determine the serialization for.
+    :param compression: Compression to use.
+    :param channel_type: dtype to use for channel serialization. If not specified, derive from value.
+    :param copy: If False, uncompressed arrays are returned as they are (buffer protocol) instead of copied to bytes.
+    :param block_size: Compression block size in number of elements. None to use the default of the compression.
+    :return: Function value -> bytes ready to be sent over the channel.
+    """
     if compression not in compression_provider_mapping:
         error_message = "Channel compression '%s' not supported." % compression
         _logger.error(error_message)
@@ -187,8 +268,68 @@ def get_value_bytes(value, compression=None, channel_type=None):
         dtype = get_serialization_type(channel_type)
 
     if serializer:
-        value = serializer(value, dtype)
+        def value_serializer(value_to_serialize):
+            return compressor(serializer(value_to_serialize, dtype), dtype, copy=copy, block_size=block_size)
+    else:
+        def value_serializer(value_to_serialize):
+            return compressor(value_to_serialize, dtype, copy=copy, block_size=block_size)
+
+    return value_serializer
+
+
+def tune_channel_compression(value, metadata, min_compression_ratio=DEFAULT_MIN_COMPRESSION_RATIO):
+    """
+    Tune the compression of a channel on a representative value. If the compression of the channel supports it, the
+    best compression block size is stored in the metadata ('compression_block_size', in number of elements). If the
+    compression does not reach min_compression_ratio, the compression of the channel is set to 'none'.
+    :param value: Representative value of the channel.
+    :param metadata: Channel metadata to tune (modified in place).
+    :param min_compression_ratio: Minimal ratio (uncompressed/compressed size) to keep the compression.
+    :return: Tuned metadata.
+    """
+    compression_provider = compression_provider_mapping.get(metadata.get("compression"))
+
+    # Strings and scalars are not worth tuning.
+    if not hasattr(compression_provider, "tune_compression_block_size") or \
+            not isinstance(value, (numpy.ndarray, list)) or metadata.get("type") == "string":
+        return metadata
+
+    dtype, _, serializer, _ = get_channel_specs(value, extended=True)
+    if metadata.get("type"):
+        dtype = get_serialization_type(metadata["type"])
+
+    numpy_array = numpy.ascontiguousarray(serializer(value, dtype) if serializer else value)
+
+    block_size, compression_ratio = compression_provider.tune_compression_block_size(numpy_array)
+    _logger.debug("Channel '%s' compression ratio %.2f with block size %d.",
+                  metadata.get("name"), compression_ratio, block_size)
+
+    if compression_ratio < min_compression_ratio:
+        metadata["compression"] = "none"
+        metadata.pop("compression_block_size", None)
+    else:
+        metadata["compression_block_size"] = block_size
+
+    return metadata
+
+
+def get_value_signature(value):
+    """
+    Get the signature (type and shape) of a value. Values with the same signature have the same channel specs.
+    :param value: Value to get the signature of.
+    :return: Hashable signature.
+    """
+    if isinstance(value, numpy.ndarray):
+        return type(value), value.dtype, value.shape
+
+    elif isinstance(value, list):
+        # Get to the bottom of the list - the lengths along the way are the shape.
+        shape = []
+        base_value = value
+        while isinstance(base_value, list) and base_value:
+            shape.append(len(base_value))
+            base_value = base_value[0]
 
-    compressed_bytes_array = compressor(value, dtype)
+        return type(value), tuple(shape), type(base_value)
 
-    return compressed_bytes_array
+    return type(value)
@@ -2,7 +2,9 @@ from logging import getLogger
 
 import numpy
 
-from bsread.data.compression import NoCompression, BitshuffleLZ4
+import bitshuffle
+
+from bsread.data.compression import NoCompression, BitshuffleLZ4, BitshuffleZstd, LZ4, lz4
 
 _logger = getLogger(__name__)
 
@@ -80,6 +82,24 @@ compression_provider_mapping = {
 }
 
 
+def register_compression_provider(compression, compression_provider):
+    """
+    Register a compression provider. Channels select it with the compression field of the data header.
+    :param compression: Compression name.
+    :param compression_provider: Provider with unpack_data(raw_bytes, dtype, shape=None) and
+                                 pack_data(numpy_array, dtype, copy=True, block_size=None).
+    """
+    compression_provider_mapping[compression] = compression_provider
+
+
+# Optional codecs - only available if the underlying libraries support them.
+if hasattr(bitshuffle, "compress_zstd"):
+    register_compression_provider("bitshuffle_zstd", BitshuffleZstd)
+
+if lz4 is not None:
+    register_compression_provider("lz4", LZ4)
+
+
 # Channel type to numpy dtype and serializer mapping.
 # channel_type: (dtype, deserializer)
 channel_type_deserializer_mapping = {
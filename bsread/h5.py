@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import h5py
 import mflow
+import numpy
 from bsread.data.serialization import channel_type_deserializer_mapping
 from bsread.handlers import extended
 import zmq
@@ -14,14 +15,25 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(name)s - %(message)s')
 
 
-def receive(source, file_name, queue_size=100, mode=zmq.PULL, n_messages=None, message_processor=None):
-    handler = extended.Handler()
+def receive(source, file_name, queue_size=100, mode=zmq.PULL, n_messages=None, message_processor=None,
+            buffer_size=None, compression=None, shuffle=False, rate=None, raw=False, writer_queue_size=None,
+            drop_messages=False, flush_interval=wr.DEFAULT_FLUSH_INTERVAL):
+    # In raw mode bitshuffle_lz4 compressed channels are not decoded, but written directly as compressed chunks.
+    handler = extended.Handler(raw_compressed=raw)
     receiver = mflow.connect(source, conn_type="connect", queue_size=queue_size, mode=mode)
 
     if message_processor is None:
         message_processor = process_message
 
-    writer = wr.Writer()
+    # With buffer_size, rows are collected and written buffer_size rows at once per dataset (at least every
+    # flush_interval seconds). The datasets are created with the size of the expected number of messages.
+    writer = wr.Writer(buffer_size=buffer_size, flush_interval=flush_interval or None, compression=compression,
+                       shuffle=shuffle, rate=rate, expected_messages=n_messages)
+
+    # With writer_queue_size, the file is written on a separate thread - HDF5 stalls do not block the receiving.
+    if writer_queue_size:
+        writer = wr.WriterThread(writer, queue_size=writer_queue_size, drop_messages=drop_messages).start()
+
     writer.open_file(file_name)
 
     first_iteration = True
@@ -33,6 +45,9 @@ def receive(source, file_name, queue_size=100, mode=zmq.PULL, n_messages=None, m
         while n_messages != 0:
             success = message_processor(handler, receiver, writer, first_iteration)
 
+            if writer_queue_size:
+                writer.end_message()
+
             if success:
                 first_iteration = False
                 n_messages -= 1
@@ -40,6 +55,49 @@ def receive(source, file_name, queue_size=100, mode=zmq.PULL, n_messages=None, m
     finally:
         writer.close_file()
 
+        if writer_queue_size:
+            logger.info("Writer queue: max depth %d/%d, stall time %.3fs, dropped messages %d" %
+                        (writer.max_queue_depth, writer_queue_size, writer.stall_time, writer.messages_dropped))
+
+
+def add_channel_dataset(writer, dataset_name, channel, raw_compressed=False):
+    """
+    Add the dataset for the values of a channel.
+    :param writer: Writer to add the dataset to.
+    :param dataset_name: Name of the dataset.
+    :param channel: Channel definition of the data header.
+    :param raw_compressed: The handler returns bitshuffle_lz4 compressed values as raw bytes - write them directly as
+                           chunks.
+    """
+    channel_type = channel.get('type')
+
+    if channel_type and channel_type.lower() == "string":
+        shape = [1]
+        maxshape = [None]
+        dtype = h5py.special_dtype(vlen=str)
+
+        writer.add_dataset(dataset_name, dataset_group_name='data', shape=shape, maxshape=maxshape, dtype=dtype)
+
+    else:
+        dtype = channel_type_deserializer_mapping[channel_type][0]
+
+        if 'shape' in channel:
+            # H5 is slowest dimension first, but bsread is fastest dimension first.
+            shape = [1] + channel['shape'][::-1]
+            maxshape = [None] + channel['shape'][::-1]
+            print(shape, "  ", maxshape, channel['name'])
+        else:
+            shape = [1]
+            maxshape = [None]
+
+        if raw_compressed and extended.is_raw_channel(channel):
+            # The chunks are stored as received - keep the byte order of the channel.
+            dtype = numpy.dtype(dtype).newbyteorder('>' if channel.get('encoding') in ('>', 'big') else '<')
+            writer.add_dataset(dataset_name, dataset_group_name='data', shape=shape, maxshape=maxshape, dtype=dtype,
+                               direct_chunk=True)
+        else:
+            writer.add_dataset(dataset_name, dataset_group_name='data', shape=shape, maxshape=maxshape, dtype=dtype)
+
 
 def process_message_compact(handler, receiver, writer, first_iteration):
     message_data = receiver.receive(handler=handler.receive)
@@ -62,30 +120,7 @@ def process_message_compact(handler, receiver, writer, first_iteration):
 
         # Interpret the data header and add required datasets
         for channel in data_header['channels']:
-            channel_type = channel.get('type')
-
-            if channel_type and channel_type.lower() == "string":
-                shape = [1]
-                maxshape = [None]
-                dtype = h5py.special_dtype(vlen=str)
-
-                writer.add_dataset('/data/' + channel['name'], dataset_group_name='data', shape=shape,
-                                   maxshape=maxshape, dtype=dtype)
-
-            else:
-
-                dtype = channel_type_deserializer_mapping[channel_type][0]
-
-                if 'shape' in channel:
-                    # H5 is slowest dimension first, but bsread is fastest dimension first.
-                    shape = [1] + channel['shape'][::-1]
-                    maxshape = [None] + channel['shape'][::-1]
-
-                    print(shape, "  ", maxshape, channel['name'])
-                    writer.add_dataset('/data/' + channel['name'], dataset_group_name='data', shape=shape,
-                                       maxshape=maxshape, dtype=dtype)
-                else:
-                    writer.add_dataset('/data/' + channel['name'], dataset_group_name='data', dtype=dtype)
+            add_channel_dataset(writer, '/data/' + channel['name'], channel, handler.raw_compressed)
 
     data = message_data['data']
     logger.debug(data)
@@ -118,28 +153,7 @@ def process_message(handler, receiver, writer, first_iteration):
 
         # Interpret the data header and add required datasets
         for channel in data_header['channels']:
-            channel_type = channel.get('type')
-
-            if channel_type and channel_type.lower() == "string":
-                shape = [1]
-                maxshape = [None]
-                dtype = h5py.special_dtype(vlen=str)
-
-                writer.add_dataset('/' + channel['name'] + '/data', dataset_group_name='data', shape=shape,
-                                   maxshape=maxshape, dtype=dtype)
-            else:
-                dtype = channel_type_deserializer_mapping[channel_type][0]
-
-                if 'shape' in channel:
-                    # H5 is slowest dimension first, but bsread is fastest dimension first.
-                    shape = [1] + channel['shape'][::-1]
-                    maxshape = [None] + channel['shape'][::-1]
-
-                    print(shape, "  ", maxshape, channel['name'])
-                    writer.add_dataset('/' + channel['name'] + '/data', dataset_group_name='data', shape=shape,
-                                       maxshape=maxshape, dtype=dtype)
-                else:
-                    writer.add_dataset('/' + channel['name'] + '/data', dataset_group_name='data', dtype=dtype)
+            add_channel_dataset(writer, '/' + channel['name'] + '/data', channel, handler.raw_compressed)
 
             # Add new datasets (in different dataset groups) for timestamp, timestamp_offset and pulse_ids
             writer.add_dataset('/' + channel['name'] + '/timestamp', dataset_group_name='timestamp', dtype='i8')
@@ -173,10 +187,31 @@ def main():
                         help='Communication mode - either pull or sub (default depends on the use of -s option)')
     parser.add_argument('-q', '--queue', default=100, type=int,
                         help='Queue size of incoming queue (default = 100)')
-    parser.add_argument('-n', '--n_messages', type=int, default=None, help="Number of messages to receive."
-                                                                           "None means infinity.")
+    parser.add_argument('-n', '--n_messages', type=int, default=None, help="Number of messages to receive - the "
+                        "datasets are preallocated for this number of messages. None means infinity.")
     parser.add_argument("--compact", dest="compact_format", action="store_true", help="Use the compact version of the "
                                                                                       "file format.")
+    parser.add_argument('-b', '--buffer_size', type=int, default=None,
+                        help='Number of messages collected per dataset before they are written - rounded up to a '
+                             'multiple of the chunk size if larger than a chunk (default: write every message '
+                             'immediately)')
+    parser.add_argument('--flush_interval', type=float, default=wr.DEFAULT_FLUSH_INTERVAL,
+                        help='Write the collected messages at least every this many seconds, 0 only writes full '
+                             'buffers (with -b, default = %d)' % wr.DEFAULT_FLUSH_INTERVAL)
+    parser.add_argument('-c', '--compression', default=None, choices=wr.COMPRESSIONS,
+                        help='Compression of the datasets (default: none)')
+    parser.add_argument('--shuffle', action='store_true',
+                        help='Apply the HDF5 byte shuffle filter before lzf or gzip compression')
+    parser.add_argument('-r', '--rate', type=float, default=None,
+                        help='Expected message rate in Hz - used to choose the chunk size of the datasets')
+    parser.add_argument('--raw', action='store_true',
+                        help='Write bitshuffle_lz4 compressed channels as received, without decompressing them '
+                             '(one message per chunk)')
+    parser.add_argument('-w', '--writer_queue', type=int, default=None,
+                        help='Write the file on a separate thread, with a queue of this many messages (default: write '
+                             'on the receiving thread)')
+    parser.add_argument('--drop', action='store_true',
+                        help='Drop messages if the writer queue is full instead of waiting (with -w)')
 
     arguments = parser.parse_args()
 
@@ -218,7 +253,10 @@ def main():
 
     try:
         receive(address, filename, queue_size=queue_size, mode=mode, n_messages=arguments.n_messages,
-                message_processor=message_processor)
+                message_processor=message_processor, buffer_size=arguments.buffer_size,
+                compression=arguments.compression, shuffle=arguments.shuffle, rate=arguments.rate,
+                raw=arguments.raw, writer_queue_size=arguments.writer_queue, drop_messages=arguments.drop,
+                flush_interval=arguments.flush_interval)
 
     except KeyboardInterrupt:
         # KeyboardInterrupt is thrown if the receiving is terminated via ctrl+c
@@ -0,0 +1,245 @@
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import numpy
+
+from bsread.data.helpers import get_channel_reader, get_value_reader
+
+# Raw values smaller than this (in bytes) are decoded inline - dispatching them to a thread costs more than decoding.
+DEFAULT_PARALLEL_THRESHOLD = 64 * 1024
+
+# Number of decode plans (data headers) kept in the process wide plan cache.
+DEFAULT_PLAN_CACHE_SIZE = 16
+
+
+class Statistics:
+    """
+    Receive statistics - same attributes as the statistics of mflow.
+    """
+    def __init__(self):
+        self.messages_received = 0
+        self.bytes_received = 0
+        self.total_bytes_received = 0
+
+
+class ReceivedMessage:
+    """
+    Received message - same attributes as the messages returned by Source.receive.
+    """
+    def __init__(self, statistics, data):
+        self.statistics = statistics
+        self.data = data
+
+
+class FrameReceiver:
+    """
+    mflow receiver interface (next, has_more) on the frames of an already received multipart message - to decode
+    messages that were not received through mflow (e.g. with zmq.asyncio) with the handlers.
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+
+    def next(self, as_json=False):
+        frame = self.frames[self.index]
+        self.index += 1
+
+        if as_json:
+            return json.loads(bytes(frame))
+
+        return frame
+
+    def has_more(self):
+        return self.index < len(self.frames)
+
+
+def receive_channel_frames(receiver):
+    """
+    Read the (value, timestamp) frame pairs of all channels of the current message.
+    :param receiver: mflow receiver positioned after the data header.
+    :return: List of tuples (raw_data, raw_timestamp). raw_timestamp is None if the message ended early.
+    """
+    frames = []
+
+    while receiver.has_more():
+        raw_data = receiver.next()
+        raw_timestamp = receiver.next() if receiver.has_more() else None
+
+        frames.append((raw_data, raw_timestamp))
+
+    return frames
+
+
+def decode_timestamps(raw_timestamps, endianness):
+    """
+    Decode the timestamp frames (seconds past epoch, nanoseconds offset) of all channels of a message at once.
+    :param raw_timestamps: Timestamp frame per channel - empty or None if the channel has no timestamp.
+    :param endianness: Endianness per channel: < (little endian) or > (big endian).
+    :return: List of (timestamp, timestamp_offset) tuples of python ints, (None, None) for channels without timestamp.
+    """
+    timestamps = [(None, None)] * len(raw_timestamps)
+
+    # Timestamp frames are 2 x 8 bytes - decode them with one frombuffer on the joined frames.
+    indexes = [index for index, raw_timestamp in enumerate(raw_timestamps)
+               if raw_timestamp and len(raw_timestamp) == 16]
+
+    if indexes:
+        timestamps_array = numpy.frombuffer(b"".join([raw_timestamps[index] for index in indexes]),
+                                            dtype='<u8').reshape(-1, 2)
+
+        big_endian = [position for position, index in enumerate(indexes) if endianness[index] == '>']
+        if big_endian:
+            timestamps_array = timestamps_array.copy()
+            timestamps_array[big_endian] = timestamps_array[big_endian].byteswap()
+
+        for index, timestamp in zip(indexes, timestamps_array.tolist()):
+            timestamps[index] = tuple(timestamp)
+
+    # Frames with an unexpected size are decoded one by one.
+    if len(indexes) < len(raw_timestamps):
+        for index, raw_timestamp in enumerate(raw_timestamps):
+            if raw_timestamp and len(raw_timestamp) != 16:
+                timestamp_array = numpy.frombuffer(raw_timestamp, dtype=endianness[index] + 'u8')
+                timestamps[index] = (int(timestamp_array[0]), int(timestamp_array[1]))
+
+    return timestamps
+
+
+class ChannelDecoder:
+    """
+    Decode the raw channel values of a message, either inline or on a thread pool.
+    The bitshuffle/lz4 decompression releases the GIL, therefore large compressed channels decode in parallel.
+    """
+    def __init__(self, workers=None, threshold=DEFAULT_PARALLEL_THRESHOLD):
+        """
+        :param workers: Number of decode threads. None or 0 decodes all channels inline (on the receiving thread).
+        :param threshold: Raw values smaller than threshold bytes are always decoded inline.
+        """
+        self.workers = workers
+        self.threshold = threshold
+
+        # Thread pool is started on first use (and again after close).
+        self.executor = None
+
+    def decode(self, readers, raw_values):
+        """
+        Decode the raw values.
+        :param readers: Value reader per raw value.
+        :param raw_values: Raw value frames.
+        :return: List of decoded values (None for empty frames).
+        """
+        if not self.workers:
+            return [reader(raw_data) if raw_data else None for reader, raw_data in zip(readers, raw_values)]
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        values = [None] * len(raw_values)
+        futures = []
+
+        for index, (reader, raw_data) in enumerate(zip(readers, raw_values)):
+            if not raw_data:
+                continue
+
+            if len(raw_data) < self.threshold:
+                values[index] = reader(raw_data)
+            else:
+                futures.append((index, self.executor.submit(reader, raw_data)))
+
+        for index, future in futures:
+            values[index] = future.result()
+
+        return values
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class DecodePlan:
+    """
+    Parsed data header together with the channel definitions (name, endianness, value reader) to decode its channels.
+    Plans are shared by all handlers - the data header must not be modified (handlers pass on copies of it).
+    """
+    def __init__(self, data_header):
+        # TODO: Why do we need to pre-process the message? Source change?
+        for channel in data_header['channels']:
+            # Define endianness of data
+            # > - big endian
+            # < - little endian (default)
+            channel["encoding"] = '>' if channel.get("encoding") == "big" else '<'
+
+        self.data_header = data_header
+        self.channels_definitions = self.create_channels_definitions()
+
+    def create_channels_definitions(self):
+        """
+        Construct the channel definitions of this plan.
+        :return: List of (name, endianness, value reader) tuples.
+        """
+        return [(channel["name"], channel["encoding"], get_channel_reader(channel))
+                for channel in self.data_header['channels']]
+
+
+class DecodePlanCache:
+    """
+    LRU cache of decode plans keyed by the data header hash - shared by all handlers of the process.
+    """
+    def __init__(self, max_size=DEFAULT_PLAN_CACHE_SIZE):
+        self.max_size = max_size
+        self.plans = OrderedDict()
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_plan(self, data_header_hash, data_header_bytes, data_header_compression=None):
+        """
+        Get the decode plan of a data header. The data header is only parsed if it is not in the cache already.
+        :param data_header_hash: Hash of the data header (from the main header).
+        :param data_header_bytes: Data header frame.
+        :param data_header_compression: Compression of the data header frame.
+        :return: Decode plan.
+        """
+        # Without hash we cannot identify the data header.
+        if not data_header_hash:
+            return self.create_plan(data_header_bytes, data_header_compression)
+
+        with self.lock:
+            plan = self.plans.get(data_header_hash)
+
+            if plan is not None:
+                self.plans.move_to_end(data_header_hash)
+                self.hits += 1
+                return plan
+
+            self.misses += 1
+
+        plan = self.create_plan(data_header_bytes, data_header_compression)
+
+        with self.lock:
+            self.plans[data_header_hash] = plan
+
+            while len(self.plans) > self.max_size:
+                self.plans.popitem(last=False)
+
+        return plan
+
+    @staticmethod
+    def create_plan(data_header_bytes, data_header_compression=None):
+        data_header = json.loads(get_value_reader("string", data_header_compression,
+                                                  value_name="data_header")(data_header_bytes))
+        return DecodePlan(data_header)
+
+    def clear(self):
+        with self.lock:
+            self.plans.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Plan cache used by the handlers.
+plan_cache = DecodePlanCache()
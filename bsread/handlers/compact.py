@@ -1,17 +1,38 @@
-import json
 import logging
 import numpy
 from collections import OrderedDict
 
-from bsread.data.helpers import get_channel_reader, get_value_reader
+from bsread.data.serialization import channel_type_deserializer_mapping
+from bsread.handlers.common import ChannelDecoder, receive_channel_frames, decode_timestamps, plan_cache, \
+    DEFAULT_PARALLEL_THRESHOLD
 
 
 class Handler:
-    def __init__(self):
+    def __init__(self, decode_workers=None, decode_threshold=DEFAULT_PARALLEL_THRESHOLD, projection=None, lazy=False):
+        """
+        :param decode_workers: Number of threads to decode (decompress) the channels of a message in parallel.
+                               None (default) decodes all channels on the receiving thread.
+        :param decode_threshold: Channels with less than decode_threshold bytes are always decoded inline.
+        :param projection: Channels to decode - either a list of channel names or a function that gets the channel name
+                           and returns True if the channel is needed. The frames of all other channels are only
+                           drained, the channels are not part of the received messages. None (default) decodes all.
+        :param lazy: If True the channel values (and timestamps) of a message are only decoded when they are accessed
+                     for the first time (see LazyValue).
+        """
         # Used for detecting if the data header has changed - we need to reconstruct the channel definitions.
         self.data_header_hash = None
+        self.data_header = None
         self.channels_definitions = None
 
+        # Indexes of the channels (in the data header) selected by the projection - None if all channels are selected.
+        self.channels_projection = None
+        if projection is not None and not callable(projection):
+            projection = set(projection)
+        self.projection = projection
+
+        self.lazy = lazy
+        self.decoder = ChannelDecoder(decode_workers, decode_threshold)
+
     def receive(self, receiver):
 
         # Receive main header
@@ -21,29 +42,169 @@ class Handler:
         if not header:
             return None
 
+        return self._receive_message(header, receiver)
+
+    def receive_batch(self, receiver, batch):
+        """
+        Receive the next message and add it as a new row to the batch.
+        :param receiver: mflow receiver to read the message frames from.
+        :param batch: Batch to add the message to.
+        :return: The batch if the message was added to it. If the data header changed compared to the messages
+                 already in the batch, the message is returned on its own (as Message) - the batch needs to be cut
+                 at this point.
+        """
+        header = receiver.next(as_json=True)
+
+        # We cannot process an empty Header.
+        if not header:
+            return None
+
+        # The columns of the batch are defined by the data header - we cannot add messages with a different one.
+        if batch.hash is not None and batch.hash != header['hash']:
+            return self._receive_message(header, receiver)
+
+        self._receive_data_header(header, receiver)
+
+        if batch.hash is None:
+            batch.setup(header['hash'], self.get_projected_channels())
+
+        index = batch.size
+        batch.pulse_id[index] = header['pulse_id']
+        global_timestamp, global_timestamp_offset = self._get_global_timestamp(header)
+        if global_timestamp is not None:
+            batch.global_timestamp[index] = global_timestamp
+            batch.global_timestamp_offset[index] = global_timestamp_offset
+
+        # Receiving data
+        for (channel_name, _, _), value, (timestamp, timestamp_offset) in zip(*self._receive_values(receiver)):
+            column = batch.data[channel_name]
+
+            column.set(index, value, header['pulse_id'])
+
+            if timestamp is not None:
+                column.timestamp[index] = timestamp  # Second past epoch
+                column.timestamp_offset[index] = timestamp_offset  # Nanoseconds offset
+
+        batch.size += 1
+
+        return batch
+
+    def _receive_message(self, header, receiver):
+
         message = Message()
         message.pulse_id = header['pulse_id']
         message.hash = header['hash']
+        message.global_timestamp, message.global_timestamp_offset = self._get_global_timestamp(header)
 
-        if 'global_timestamp' in header:
-            if 'sec' in header['global_timestamp']:
-                message.global_timestamp = header['global_timestamp']['sec']
-            elif 'epoch' in header['global_timestamp']:
-                message.global_timestamp = header['global_timestamp']['epoch']
-            else:
-                raise RuntimeError("Invalid timestamp format in BSDATA header message {}".format(message))
+        message.format_changed = self._receive_data_header(header, receiver)
 
-            message.global_timestamp_offset = header['global_timestamp']['ns']
+        # Receiving data
+        if self.lazy:
+            for (channel_name, channel_endianness, channel_reader), (raw_data, raw_timestamp) in \
+                    zip(*self._receive_frames(receiver)):
+                message.data[channel_name] = LazyValue(raw_data, raw_timestamp, channel_reader, channel_endianness)
+
+            return message
+
+        # Todo add some more error checking
+        for (channel_name, _, _), value, (timestamp, timestamp_offset) in zip(*self._receive_values(receiver)):
+            message.data[channel_name] = Value(value, timestamp, timestamp_offset)
+
+        return message
 
+    def _receive_values(self, receiver):
+        """
+        Receive the frames of all channels first and then decode them (in parallel if configured).
+        Channels not selected by the projection are drained but not decoded.
+        :return: Tuple (channels_definitions, values, timestamps) of the selected channels - timestamps as returned
+                 by decode_timestamps.
+        """
+        channels_definitions, frames = self._receive_frames(receiver)
+
+        values = self.decoder.decode([channel_reader for _, _, channel_reader in channels_definitions],
+                                     [raw_data for raw_data, _ in frames])
+
+        # Channels without value do not have a timestamp.
+        timestamps = decode_timestamps([raw_timestamp if raw_data else None for raw_data, raw_timestamp in frames],
+                                       [channel_endianness for _, channel_endianness, _ in channels_definitions])
+
+        return channels_definitions, values, timestamps
+
+    def _receive_frames(self, receiver):
+        """
+        Receive the frames of all channels.
+        :return: Tuple (channels_definitions, frames) of the channels selected by the projection.
+        """
+        frames = receive_channel_frames(receiver)
+
+        if len(frames) > len(self.channels_definitions):
+            raise RuntimeError("Received %d channels but data header defines only %d channels." %
+                               (len(frames), len(self.channels_definitions)))
+
+        channels_definitions = self.channels_definitions
+
+        if self.channels_projection is not None:
+            channels_definitions = [channels_definitions[index] for index in self.channels_projection
+                                    if index < len(frames)]
+            frames = [frames[index] for index in self.channels_projection if index < len(frames)]
+
+        return channels_definitions, frames
+
+    def get_projected_channels(self):
+        """
+        :return: Channels of the current data header that are selected by the projection.
+        """
+        if not self.data_header:
+            return []
+
+        channels = self.data_header['channels']
+
+        if self.channels_projection is None:
+            return channels
+
+        return [channels[index] for index in self.channels_projection]
+
+    def _update_projection(self):
+        if self.projection is None:
+            self.channels_projection = None
+        elif callable(self.projection):
+            self.channels_projection = [index for index, (channel_name, _, _) in enumerate(self.channels_definitions)
+                                        if self.projection(channel_name)]
+        else:
+            self.channels_projection = [index for index, (channel_name, _, _) in enumerate(self.channels_definitions)
+                                        if channel_name in self.projection]
+
+    def close(self):
+        self.decoder.close()
+
+    @staticmethod
+    def _get_global_timestamp(header):
+        if 'global_timestamp' not in header:
+            return None, None
+
+        if 'sec' in header['global_timestamp']:
+            global_timestamp = header['global_timestamp']['sec']
+        elif 'epoch' in header['global_timestamp']:
+            global_timestamp = header['global_timestamp']['epoch']
+        else:
+            raise RuntimeError("Invalid timestamp format in BSDATA header message {}".format(header))
+
+        return global_timestamp, header['global_timestamp']['ns']
+
+    def _receive_data_header(self, header, receiver):
+        """
+        Read the data header frame and recreate the channel definitions if the data header has changed.
+        :return: True if the channel definitions were recreated.
+        """
         # Receiver data header, check if header has changed - and in this case recreate the channel definitions.
         if receiver.has_more() and (self.data_header_hash != header['hash']):
             # Set the current header hash as the new hash.
             self.data_header_hash = header['hash']
 
-            # Read the data header.
+            # Read the data header - it is only parsed if its decode plan is not cached already.
             data_header_bytes = receiver.next()
-            data_header = json.loads(get_value_reader("string", header.get('dh_compression'),
-                                                      value_name="data_header")(data_header_bytes))
+            plan = plan_cache.get_plan(header['hash'], data_header_bytes, header.get('dh_compression'))
+            data_header = plan.data_header
 
             # If a message with ho channel information is received,
             # ignore it and return from function with no data.
@@ -53,55 +214,24 @@ class Handler:
                     # Drain rest of the messages - if entering this code there is actually something wrong
                     receiver.next()
 
-                return message
+                self.data_header = None
+                self.channels_definitions = []
+                self._update_projection()
+
+                return False
 
-            # TODO: Why do we need to pre-process the message? Source change?
-            for channel in data_header['channels']:
-                # Define endianness of data
-                # > - big endian
-                # < - little endian (default)
-                channel["encoding"] = '>' if channel.get("encoding") == "big" else '<'
+            self.channels_definitions = plan.channels_definitions
+            self.data_header = data_header
 
-            # Construct the channel definitions.
-            self.channels_definitions = [(channel["name"], channel["encoding"], get_channel_reader(channel))
-                                         for channel in data_header['channels']]
+            self._update_projection()
 
             # Signal that the format has changed.
-            message.format_changed = True
+            return True
         else:
             # Skip second header - we already have the receive functions setup.
             receiver.next()
 
-        # Receiving data
-        counter = 0
-
-        # Todo add some more error checking
-        while receiver.has_more():
-            channel_name, channel_endianness, channel_reader = self.channels_definitions[counter]
-
-            raw_data = receiver.next()
-            channel_value = Value()
-
-            if raw_data:
-                channel_value.value = channel_reader(raw_data)
-
-                if receiver.has_more():
-
-                    raw_timestamp = receiver.next()
-
-                    if raw_timestamp:
-                        timestamp_array = numpy.frombuffer(raw_timestamp, dtype=channel_endianness + 'u8')
-                        channel_value.timestamp = timestamp_array[0]  # Second past epoch
-                        channel_value.timestamp_offset = timestamp_array[1]  # Nanoseconds offset
-            else:
-                # Consume empty timestamp message
-                if receiver.has_more():
-                    receiver.next()  # Read empty timestamp message
-
-            message.data[channel_name] = channel_value
-            counter += 1
-
-        return message
+            return False
 
 
 class Message:
@@ -117,6 +247,17 @@ class Message:
 
         self.format_changed = False
 
+    def copy(self):
+        """
+        Detach the message from the received frames. Use this if you keep the message after the next receive with
+        Source(copy=False), otherwise the values keep the (zmq) receive buffers alive.
+        :return: Message with copies of all values.
+        """
+        message = Message(self.pulse_id, self.global_timestamp, self.global_timestamp_offset, self.hash,
+                          OrderedDict((name, value.copy()) for name, value in self.data.items()))
+        message.format_changed = self.format_changed
+        return message
+
     def __str__(self):
         message = "pulse_id: %d \ndata: " % self.pulse_id + str(self.data)
         return message
@@ -127,3 +268,191 @@ class Value:
         self.value = value
         self.timestamp = timestamp
         self.timestamp_offset = timestamp_offset
+
+    def copy(self):
+        """
+        Detach the value from the received frame - array values are read-only views on it.
+        :return: Value with a writable copy of the array value.
+        """
+        value = self.value
+        if isinstance(value, numpy.ndarray):
+            value = value.copy()
+
+        return Value(value, self.timestamp, self.timestamp_offset)
+
+
+class LazyValue(Value):
+    """
+    Value that keeps the received frames and decodes them on first access only. The decoded value is memoized.
+    """
+    def __init__(self, raw_data, raw_timestamp, reader, endianness):
+        self._raw_data = raw_data
+        self._raw_timestamp = raw_timestamp if raw_data else None
+        self._reader = reader
+        self._endianness = endianness
+
+        self._value = None
+        self._timestamp = None
+        self._timestamp_offset = None
+
+    @property
+    def value(self):
+        if self._reader is not None:
+            self._value = self._reader(self._raw_data) if self._raw_data else None
+            self._reader = None
+            self._raw_data = None
+
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._reader = None
+        self._raw_data = None
+
+    @property
+    def timestamp(self):
+        self._decode_timestamp()
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self._decode_timestamp()
+        self._timestamp = timestamp
+
+    @property
+    def timestamp_offset(self):
+        self._decode_timestamp()
+        return self._timestamp_offset
+
+    @timestamp_offset.setter
+    def timestamp_offset(self, timestamp_offset):
+        self._decode_timestamp()
+        self._timestamp_offset = timestamp_offset
+
+    def _decode_timestamp(self):
+        if self._raw_timestamp:
+            timestamp_array = numpy.frombuffer(self._raw_timestamp, dtype=self._endianness + 'u8')
+            self._timestamp = int(timestamp_array[0])  # Second past epoch
+            self._timestamp_offset = int(timestamp_array[1])  # Nanoseconds offset
+
+        self._raw_timestamp = None
+
+
+class Batch:
+    """
+    Columnar block of consecutive messages that share the same data header.
+    All arrays are preallocated for capacity messages; only the first size rows are valid.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.hash = None
+
+        self.pulse_id = numpy.zeros(capacity, dtype='i8')
+        self.global_timestamp = numpy.zeros(capacity, dtype='i8')
+        self.global_timestamp_offset = numpy.zeros(capacity, dtype='i8')
+
+        self.data = OrderedDict()  # Dictionary of columns
+
+    def setup(self, hash, channels):
+        """
+        Allocate the channel columns for the provided data header.
+        :param hash: Hash of the data header.
+        :param channels: Channels of the (pre-processed) data header.
+        """
+        self.hash = hash
+        self.data = OrderedDict((channel["name"], Column.from_channel(channel, self.capacity))
+                                for channel in channels)
+
+    def add_message(self, message):
+        """
+        Add an already decoded message as a new row.
+        :param message: Message with the same data header as the batch.
+        """
+        index = self.size
+        self.pulse_id[index] = message.pulse_id
+        if message.global_timestamp is not None:
+            self.global_timestamp[index] = message.global_timestamp
+            self.global_timestamp_offset[index] = message.global_timestamp_offset
+
+        for channel_name, channel_value in message.data.items():
+            column = self.data[channel_name]
+            if channel_value.value is not None:
+                column.set(index, channel_value.value, message.pulse_id)
+            if channel_value.timestamp is not None:
+                column.timestamp[index] = channel_value.timestamp
+                column.timestamp_offset[index] = channel_value.timestamp_offset
+
+        self.size += 1
+
+    def trim(self):
+        """
+        Shrink all arrays to the number of received messages. The arrays are views on the preallocated ones.
+        """
+        self.pulse_id = self.pulse_id[:self.size]
+        self.global_timestamp = self.global_timestamp[:self.size]
+        self.global_timestamp_offset = self.global_timestamp_offset[:self.size]
+
+        for column in self.data.values():
+            column.trim(self.size)
+
+        self.capacity = self.size
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return "pulse_id: %s \ndata: " % str(self.pulse_id) + str(list(self.data.keys()))
+
+
+class Column:
+    """
+    Values of one channel for all messages of a batch. Rows without data are marked in valid.
+    """
+    def __init__(self, dtype, shape, capacity):
+        self.value = numpy.zeros((capacity,) + tuple(shape), dtype=dtype)
+        self.timestamp = numpy.zeros(capacity, dtype='i8')
+        self.timestamp_offset = numpy.zeros(capacity, dtype='i8')
+        self.pulse_id = numpy.zeros(capacity, dtype='i8')
+        self.valid = numpy.zeros(capacity, dtype=bool)
+
+    @staticmethod
+    def from_channel(channel, capacity):
+        channel_type = channel['type'].lower() if 'type' in channel else None
+
+        if channel_type == 'string' or channel_type not in channel_type_deserializer_mapping:
+            dtype = object
+        else:
+            dtype = channel.get('encoding', '') + channel_type_deserializer_mapping[channel_type][0]
+
+        # Scalars are stored as 1D column, waveforms and images get an additional dimension per row.
+        shape = channel.get('shape')
+        if shape is None or shape == [1] or dtype is object:
+            shape = []
+        else:
+            # Numpy is slowest dimension first, but bsread is fastest dimension first.
+            shape = shape[::-1]
+
+        return Column(dtype, shape, capacity)
+
+    def set(self, index, value, pulse_id):
+        if value is None:
+            return
+
+        try:
+            self.value[index] = value
+        except ValueError:
+            logging.warning("Value with shape %s does not fit into column with shape %s - skipping value.",
+                            numpy.shape(value), self.value.shape[1:])
+            return
+
+        self.pulse_id[index] = pulse_id
+        self.valid[index] = True
+
+    def trim(self, size):
+        self.value = self.value[:size]
+        self.timestamp = self.timestamp[:size]
+        self.timestamp_offset = self.timestamp_offset[:size]
+        self.pulse_id = self.pulse_id[:size]
+        self.valid = self.valid[:size]
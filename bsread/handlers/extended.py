@@ -1,17 +1,28 @@
-import json
-
+import copy
 import logging
-import numpy
 
-from bsread.data.helpers import get_channel_reader, get_value_reader
+from bsread.handlers.common import ChannelDecoder, receive_channel_frames, decode_timestamps, plan_cache, \
+    DEFAULT_PARALLEL_THRESHOLD
 
 
 class Handler:
 
-    def __init__(self):
+    def __init__(self, decode_workers=None, decode_threshold=DEFAULT_PARALLEL_THRESHOLD, raw_compressed=False):
+        """
+        :param decode_workers: Number of threads to decode (decompress) the channels of a message in parallel.
+                               None (default) decodes all channels on the receiving thread.
+        :param decode_threshold: Channels with less than decode_threshold bytes are always decoded inline.
+        :param raw_compressed: If True, the values of bitshuffle_lz4 compressed channels are not decoded - their raw
+                               (compressed) bytes are returned instead, e.g. to write them directly as HDF5 chunks.
+        """
         self.data_header_hash = None
         self.data_header = None
         self.channels_definitions = None
+        self.channels_readers = None
+
+        self.raw_compressed = raw_compressed
+
+        self.decoder = ChannelDecoder(decode_workers, decode_threshold)
 
     def receive(self, receiver):
 
@@ -36,10 +47,12 @@ class Handler:
 
             self.data_header_hash = header['hash']
 
-            # Read the data header.
+            # Read the data header - it is only parsed if its decode plan is not cached already.
             data_header_bytes = receiver.next()
-            data_header = json.loads(get_value_reader("string", header.get('dh_compression'),
-                                                      value_name="data_header")(data_header_bytes))
+            plan = plan_cache.get_plan(header['hash'], data_header_bytes, header.get('dh_compression'))
+
+            # The data header is passed on with every message - the cached one of the plan must not be modified.
+            data_header = copy.deepcopy(plan.data_header)
 
             # If a message with ho channel information is received,
             # ignore it and return from function with no data.
@@ -60,16 +73,13 @@ class Handler:
 
                 return return_value
 
-            # TODO: Why do we need to pre-process the message? Source change?
-            for channel in data_header['channels']:
-                # Define endianness of data
-                # > - big endian
-                # < - little endian (default)
-                channel["encoding"] = '>' if channel.get("encoding") == "big" else '<'
+            self.channels_definitions = plan.channels_definitions
 
-            # Construct the channel definitions.
-            self.channels_definitions = [(channel["name"], channel["encoding"], get_channel_reader(channel))
-                                         for channel in data_header['channels']]
+            self.channels_readers = [channel_reader for _, _, channel_reader in self.channels_definitions]
+            if self.raw_compressed:
+                for index, channel in enumerate(data_header['channels']):
+                    if is_raw_channel(channel):
+                        self.channels_readers[index] = bytes
 
             self.data_header = data_header
         else:
@@ -79,38 +89,35 @@ class Handler:
         # The data header should be added to every message.
         return_value['data_header'] = self.data_header
 
-        # Receiving data
-        counter = 0
-        # msg_data_size = 0
-        while receiver.has_more():
-            channel_name, channel_endianness, channel_reader = self.channels_definitions[counter]
+        # Receiving data - receive the frames of all channels first and then decode them (in parallel if configured).
+        frames = receive_channel_frames(receiver)
 
-            raw_data = receiver.next()
+        if len(frames) > len(self.channels_definitions):
+            raise RuntimeError("Received %d channels but data header defines only %d channels." %
+                               (len(frames), len(self.channels_definitions)))
 
-            if raw_data:
-                pulse_ids.append(pulse_id)
+        values = self.decoder.decode(self.channels_readers, [raw_data for raw_data, _ in frames])
 
-                data.append(channel_reader(raw_data))
+        timestamps = decode_timestamps([raw_timestamp for _, raw_timestamp in frames],
+                                       [channel_endianness for _, channel_endianness, _ in self.channels_definitions])
 
-                if receiver.has_more():
+        # msg_data_size = 0
+        for (raw_data, _), value, (channel_timestamp, channel_timestamp_offset) in zip(frames, values, timestamps):
 
-                    raw_timestamp = receiver.next()
+            if raw_data:
+                pulse_ids.append(pulse_id)
 
-                    if raw_timestamp:
-                        timestamp_array = numpy.frombuffer(raw_timestamp, dtype=channel_endianness + 'u8')
-                        timestamp.append(timestamp_array[0])  # Second past epoch
-                        timestamp_offset.append(timestamp_array[1])  # Nanoseconds offset
-            else:
-                if receiver.has_more():
-                    receiver.next()  # Read empty timestamp message
+                data.append(value)
 
+                if channel_timestamp is not None:
+                    timestamp.append(channel_timestamp)  # Second past epoch
+                    timestamp_offset.append(channel_timestamp_offset)  # Nanoseconds offset
+            else:
                 data.append(None)
                 timestamp.append(None)
                 timestamp_offset.append(None)
                 pulse_ids.append(None)
 
-            counter += 1
-
         # Todo need to add some more error checking
 
         return_value['header'] = header
@@ -123,3 +130,17 @@ class Handler:
         # return_value['size'] = msg_data_size
 
         return return_value
+
+    def close(self):
+        self.decoder.close()
+
+
+def is_raw_channel(channel):
+    """
+    Check whether the raw bytes of a channel can be stored as they are - bitshuffle_lz4 compressed channels have the
+    format of the HDF5 bitshuffle filter chunks.
+    :param channel: Channel definition of the data header.
+    :return: True if the channel is a bitshuffle_lz4 compressed array or scalar.
+    """
+    return channel.get('compression') == 'bitshuffle_lz4' and channel.get('type', '').lower() != 'string'
+
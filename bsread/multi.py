@@ -0,0 +1,307 @@
+import heapq
+import time
+from collections import deque, OrderedDict
+
+import mflow
+import zmq
+
+from bsread.handlers.compact import Handler
+
+PULL = mflow.PULL
+SUB = mflow.SUB
+
+CONNECT = "connect"
+BIND = "bind"
+
+# Maximum number of pulses buffered by the merger.
+DEFAULT_MERGE_WINDOW = 100
+# Time in seconds the merger waits for the missing sources of a pulse.
+DEFAULT_MERGE_TIMEOUT = 1.0
+
+
+class MultiSource:
+    """
+    Receive from several streams at once. A single zmq.Poller waits for all streams, messages are received from
+    whichever stream is ready - an idle or slow stream does not hold back the others. Each stream is decoded with its
+    own handler (data header state).
+    """
+
+    def __init__(self, sources, conn_type=CONNECT, mode=PULL, queue_size=100, copy=True, max_messages_per_source=1,
+                 decode_workers=None, projection=None, lazy=False):
+        """
+        :param sources: Streams to receive from - dictionary name -> address (e.g. as returned by
+                        dispatchers.request_streams) or list of addresses (the address is used as name).
+        :param conn_type: Connect (CONNECT) or bind (BIND) to the addresses.
+        :param mode: Data delivery mode - PULL or SUB.
+        :param queue_size: Queue size per stream.
+        :param copy: If False, frames are received without copying them out of zmq (see Source).
+        :param max_messages_per_source: Fair share - maximum number of messages received from one stream per poll.
+                                        None receives all messages a stream has ready.
+        :param decode_workers: Number of decode threads per stream (see Source).
+        :param projection: Channels to decode (see Source).
+        :param lazy: If True, channel values are only decoded when accessed for the first time (see Source).
+        """
+        if not isinstance(sources, dict):
+            sources = {address: address for address in sources}
+
+        self.sources = sources
+        self.conn_type = conn_type
+        self.mode = mode
+        self.queue_size = queue_size
+        self.copy = copy
+        self.max_messages_per_source = max_messages_per_source
+
+        self.handler_options = {"decode_workers": decode_workers, "projection": projection, "lazy": lazy}
+
+        self.streams = {}
+        self.handlers = {}
+        self.poller = None
+
+        # Name of the source per socket - to map the poll events back to the sources.
+        self.socket_names = {}
+
+        # Received, but not yet returned (name, message) tuples.
+        self.pending_messages = deque()
+
+    def connect(self):
+        self.poller = zmq.Poller()
+
+        for name, address in self.sources.items():
+            stream = mflow.connect(address, conn_type=self.conn_type, queue_size=self.queue_size, mode=self.mode,
+                                   copy=self.copy)
+
+            self.streams[name] = stream
+            self.handlers[name] = Handler(**self.handler_options)
+
+            self.poller.register(stream.socket, zmq.POLLIN)
+            self.socket_names[stream.socket] = name
+
+        return self
+
+    def disconnect(self):
+        for name, stream in self.streams.items():
+            self.poller.unregister(stream.socket)
+            stream.disconnect()
+            self.handlers[name].close()
+
+        self.streams.clear()
+        self.handlers.clear()
+        self.socket_names.clear()
+        self.pending_messages.clear()
+
+    def poll(self, timeout=None):
+        """
+        Wait until at least one stream is ready and receive the messages of all ready streams - at most
+        max_messages_per_source per stream.
+        :param timeout: Maximum time in seconds to wait. None waits until a message arrives.
+        :return: List of (name, message) tuples, empty if no message arrived within the timeout.
+        """
+        events = self.poller.poll(None if timeout is None else int(timeout * 1000))
+
+        messages = []
+        for socket, _ in events:
+            name = self.socket_names[socket]
+            stream = self.streams[name]
+            handler = self.handlers[name]
+
+            n_messages = 0
+            while True:
+                message = stream.receive(handler=handler.receive)
+
+                # Empty messages are decoded to None.
+                if message is not None and message.data is not None:
+                    messages.append((name, message))
+
+                n_messages += 1
+                if self.max_messages_per_source and n_messages >= self.max_messages_per_source:
+                    break
+
+                # Only receive what is already there.
+                if not socket.poll(0):
+                    break
+
+        return messages
+
+    def receive(self, timeout=None):
+        """
+        Receive the next message of any stream.
+        :param timeout: Maximum time in seconds to wait. None waits until a message arrives.
+        :return: Tuple (name, message), None if no message arrived within the timeout.
+        """
+        if not self.pending_messages:
+            self.pending_messages.extend(self.poll(timeout))
+
+            if not self.pending_messages:
+                return None
+
+        return self.pending_messages.popleft()
+
+    def __iter__(self):
+        while True:
+            yield self.receive()
+
+    def receive_merged(self, window=DEFAULT_MERGE_WINDOW, timeout=DEFAULT_MERGE_TIMEOUT, merger=None):
+        """
+        Receive the messages of all streams merged by pulse_id (see PulseMerger).
+        :param window: Maximum number of pulses waiting for missing sources.
+        :param timeout: Time in seconds to wait for the missing sources of a pulse.
+        :param merger: Merger to use - e.g. to access its statistics. If given window and timeout are ignored.
+        :return: Generator of merged messages (MergedMessage), in pulse_id order.
+        """
+        if merger is None:
+            merger = PulseMerger(list(self.sources.keys()), window=window, timeout=timeout)
+
+        while True:
+            for name, message in self.poll(merger.timeout / 2):
+                yield from merger.add(name, message.data)
+
+            yield from merger.flush()
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, type, value, traceback):
+        self.disconnect()
+
+
+class MergedMessage:
+    """
+    Messages of all sources with the same pulse_id. Sources that did not deliver the pulse (within the timeout or
+    merge window) have None as message.
+    """
+    def __init__(self, pulse_id, names, messages):
+        self.pulse_id = pulse_id
+        self.names = names
+        self.messages = messages
+
+    @property
+    def complete(self):
+        return all(message is not None for message in self.messages)
+
+    def get_message(self, name):
+        return self.messages[self.names.index(name)]
+
+    @property
+    def data(self):
+        """
+        Values of all sources in one dictionary (channel name -> Value). Built on access.
+        """
+        data = OrderedDict()
+        for message in self.messages:
+            if message is not None:
+                data.update(message.data)
+        return data
+
+
+class MergeStatistics:
+    def __init__(self):
+        self.complete_pulses = 0
+        self.incomplete_pulses = 0
+        # Messages that arrived after their pulse was emitted.
+        self.late_messages = 0
+        # Messages of a source for a pulse already received from this source.
+        self.duplicated_messages = 0
+        # Number of times a pulse was missing, per source.
+        self.missing_messages = None
+
+
+class PulseMerger:
+    """
+    Align the messages of several sources by pulse_id. Messages are buffered in a bounded window until all sources
+    delivered the pulse, the timeout passed or the window is full. Merged messages are emitted in pulse_id order.
+    """
+
+    def __init__(self, names, window=DEFAULT_MERGE_WINDOW, timeout=DEFAULT_MERGE_TIMEOUT):
+        """
+        :param names: Names of the sources to merge.
+        :param window: Maximum number of pulses waiting for missing sources - the oldest pulse is emitted incomplete
+                       if a new pulse does not fit into the window anymore.
+        :param timeout: Time in seconds to wait for the missing sources of a pulse (from its first message).
+        """
+        self.names = list(names)
+        self.indexes = {name: index for index, name in enumerate(self.names)}
+        self.window = window
+        self.timeout = timeout
+
+        # pulse_id -> [messages per source, number of received messages, time of first message]
+        self.pulses = {}
+        # Heap of the pending pulse_ids.
+        self.pulse_ids = []
+
+        # Highest pulse_id emitted so far - messages for older pulses are late.
+        self.last_pulse_id = None
+
+        self.statistics = MergeStatistics()
+        self.statistics.missing_messages = {name: 0 for name in self.names}
+
+    def add(self, name, message):
+        """
+        Add a received message.
+        :param name: Name of the source the message was received from.
+        :param message: Received message (compact handler message).
+        :return: List of merged messages ready to be emitted.
+        """
+        pulse_id = message.pulse_id
+
+        if self.last_pulse_id is not None and pulse_id <= self.last_pulse_id:
+            self.statistics.late_messages += 1
+            return []
+
+        pulse = self.pulses.get(pulse_id)
+        if pulse is None:
+            pulse = [[None] * len(self.names), 0, time.time()]
+            self.pulses[pulse_id] = pulse
+            heapq.heappush(self.pulse_ids, pulse_id)
+
+        index = self.indexes[name]
+        if pulse[0][index] is not None:
+            self.statistics.duplicated_messages += 1
+        else:
+            pulse[1] += 1
+        pulse[0][index] = message
+
+        merged_messages = []
+
+        # All sources delivered the pulse - older pending pulses cannot complete anymore (streams are in order).
+        if pulse[1] == len(self.names):
+            while self.pulse_ids and self.pulse_ids[0] <= pulse_id:
+                merged_messages.append(self._emit())
+
+        # Window full - emit the oldest pulses.
+        while len(self.pulse_ids) > self.window:
+            merged_messages.append(self._emit())
+
+        return merged_messages
+
+    def flush(self, all_pulses=False):
+        """
+        Emit the pulses whose timeout passed.
+        :param all_pulses: Emit all pending pulses (e.g. at the end of the streams).
+        :return: List of merged messages.
+        """
+        merged_messages = []
+        deadline = time.time() - self.timeout
+
+        # Pulses are emitted in order - a timed out pulse also releases the older ones.
+        timed_out = [pulse_id for pulse_id in self.pulse_ids if self.pulses[pulse_id][2] <= deadline]
+        last_pulse_id = max(self.pulse_ids) if all_pulses and self.pulse_ids else max(timed_out, default=None)
+
+        while last_pulse_id is not None and self.pulse_ids and self.pulse_ids[0] <= last_pulse_id:
+            merged_messages.append(self._emit())
+
+        return merged_messages
+
+    def _emit(self):
+        pulse_id = heapq.heappop(self.pulse_ids)
+        messages, n_messages, _ = self.pulses.pop(pulse_id)
+
+        if n_messages == len(self.names):
+            self.statistics.complete_pulses += 1
+        else:
+            self.statistics.incomplete_pulses += 1
+            for name, message in zip(self.names, messages):
+                if message is None:
+                    self.statistics.missing_messages[name] += 1
+
+        self.last_pulse_id = pulse_id
+        return MergedMessage(pulse_id, self.names, messages)
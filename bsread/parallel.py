@@ -0,0 +1,282 @@
+import heapq
+import logging
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import mflow
+import numpy
+
+from bsread.handlers.common import ReceivedMessage, Statistics
+from bsread.handlers.compact import Handler
+
+_logger = logging.getLogger(__name__)
+
+PULL = mflow.PULL
+
+CONNECT = "connect"
+BIND = "bind"
+
+# Arrays of at least this size (in bytes) are passed from the workers to the parent via shared memory.
+DEFAULT_SHARED_MEMORY_THRESHOLD = 64 * 1024
+
+# Maximum number of messages held back to reorder them by pulse_id.
+DEFAULT_REORDER_WINDOW = 100
+
+# Interval in seconds in which the workers check whether they need to stop.
+POLL_INTERVAL = 0.1
+
+
+class _SharedBlock:
+    """
+    Owner of a mapped shared memory block, used as base of the arrays returned by SharedArray.get. The memory is
+    exposed via the array interface (no buffer export), so the block can be closed when the last array is gone.
+    """
+    def __init__(self, shm, shape, dtype):
+        self.shm = shm
+        address = numpy.frombuffer(shm.buf, dtype=numpy.uint8).ctypes.data
+        self.__array_interface__ = {"shape": shape, "typestr": dtype.str, "descr": dtype.descr,
+                                    "data": (address, False), "version": 3}
+
+    def __del__(self):
+        self.shm.close()
+
+
+class SharedArray:
+    """
+    Array passed from a worker to the parent process in a shared memory block.
+    """
+    def __init__(self, array):
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        numpy.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)[...] = array
+
+        self.name = shm.name
+        shm.close()
+
+    def get(self):
+        """
+        Map the shared memory block into this process and return the array as a view on it. The block is unlinked
+        right away, the mapping is released once the array (and all views on it) are garbage collected.
+        :return: Array.
+        """
+        shm = shared_memory.SharedMemory(name=self.name)
+        shm.unlink()
+        return numpy.asarray(_SharedBlock(shm, self.shape, self.dtype))
+
+    def release(self):
+        shm = shared_memory.SharedMemory(name=self.name)
+        shm.close()
+        shm.unlink()
+
+
+def _share_values(message, threshold):
+    for value in message.data.values():
+        if isinstance(value.value, numpy.ndarray) and value.value.nbytes >= threshold:
+            value.value = SharedArray(value.value)
+
+
+def _restore_values(message):
+    for value in message.data.values():
+        if isinstance(value.value, SharedArray):
+            value.value = value.value.get()
+
+
+def _release_values(message):
+    for value in message.data.values():
+        if isinstance(value.value, SharedArray):
+            value.value.release()
+
+
+def _decode_messages(worker_index, address, conn_type, mode, queue_size, handler_options, shared_memory_threshold,
+                     results, stop):
+    """
+    Worker process - receive and decode messages from its own socket and pass them to the parent.
+    """
+    stream = mflow.connect(address, conn_type=conn_type, queue_size=queue_size, mode=mode)
+    handler = Handler(**handler_options)
+
+    try:
+        while not stop.is_set():
+            # Wait with timeout - to be able to stop the worker.
+            if not stream.socket.poll(int(POLL_INTERVAL * 1000)):
+                continue
+
+            message = stream.receive(handler=handler.receive)
+            if message is None or message.data is None:
+                continue
+
+            data = message.data
+            _share_values(data, shared_memory_threshold)
+
+            while True:
+                try:
+                    results.put((worker_index, message.statistics.bytes_received, data), timeout=POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    if stop.is_set():
+                        _release_values(data)
+                        return
+    finally:
+        stream.disconnect()
+        handler.close()
+
+
+class ParallelSource:
+    """
+    Receive a (PUSH/PULL) stream with several worker processes. Each worker has its own PULL socket and decode handler,
+    so zmq distributes the messages of the stream over the workers and all cores are used for decoding. The decoded
+    messages are returned to the parent process - large arrays via shared memory - optionally reordered by pulse_id.
+
+        with ParallelSource(address='tcp://camera:9999', n_workers=4, ordered=True) as stream:
+            message = stream.receive()
+    """
+
+    def __init__(self, host=None, port=9999, address=None, n_workers=4, conn_type=CONNECT, mode=PULL, queue_size=100,
+                 projection=None, ordered=False, reorder_window=DEFAULT_REORDER_WINDOW,
+                 shared_memory_threshold=DEFAULT_SHARED_MEMORY_THRESHOLD):
+        """
+        :param host: Source to connect to.
+        :param port: Data port of the source.
+        :param address: Address of the stream - instead of host and port.
+        :param n_workers: Number of worker processes.
+        :param conn_type: Connect (CONNECT) or bind (BIND) to the address - only one worker can bind.
+        :param mode: Data delivery mode - PULL (with PUB every worker receives every message).
+        :param queue_size: Queue size of each worker socket and of the decoded messages queue.
+        :param projection: Channels to decode (see Source). Needs to be picklable (e.g. list of channel names).
+        :param ordered: If True, messages are returned in pulse_id order.
+        :param reorder_window: Maximum number of messages held back for reordering.
+        :param shared_memory_threshold: Arrays of at least this size (in bytes) are passed via shared memory.
+        """
+        if address is None:
+            address = 'tcp://' + host + ':' + str(port)
+
+        if conn_type == BIND and n_workers > 1:
+            raise ValueError("Only one worker can bind to the address.")
+
+        self.address = address
+        self.n_workers = n_workers
+        self.conn_type = conn_type
+        self.mode = mode
+        self.queue_size = queue_size
+        self.handler_options = {"projection": projection}
+        self.shared_memory_threshold = shared_memory_threshold
+
+        self.ordered = ordered
+        self.reorder_window = reorder_window
+
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = []
+        self.results = None
+        self.stop = None
+
+        self.statistics = Statistics()
+
+        # Heap of (pulse_id, sequence number, message) held back for reordering.
+        self.pending_messages = []
+        self.sequence_number = 0
+        # Last pulse_id received per worker - a message can be returned once all workers are past its pulse_id.
+        self.worker_pulse_ids = [None] * n_workers
+
+    def connect(self):
+        self.results = self.context.Queue(self.queue_size)
+        self.stop = self.context.Event()
+
+        for worker_index in range(self.n_workers):
+            worker = self.context.Process(target=_decode_messages, name="bsread-decoder-%d" % worker_index,
+                                          args=(worker_index, self.address, self.conn_type, self.mode,
+                                                self.queue_size, self.handler_options,
+                                                self.shared_memory_threshold, self.results, self.stop),
+                                          daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        return self
+
+    def disconnect(self):
+        self.stop.set()
+
+        # Drain the queue - workers cannot exit while their messages are not consumed.
+        while any(worker.is_alive() for worker in self.workers) or not self.results.empty():
+            try:
+                _, _, data = self.results.get(timeout=POLL_INTERVAL)
+                _release_values(data)
+            except queue.Empty:
+                pass
+
+        for worker in self.workers:
+            worker.join()
+
+        for _, _, data in self.pending_messages:
+            _release_values(data)
+
+        self.workers = []
+        self.pending_messages = []
+
+    def _get(self, timeout):
+        try:
+            worker_index, n_bytes, data = self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        self.statistics.messages_received += 1
+        self.statistics.bytes_received = n_bytes
+        self.statistics.total_bytes_received += n_bytes
+
+        self.worker_pulse_ids[worker_index] = data.pulse_id
+        return data
+
+    def receive(self, timeout=None):
+        """
+        Receive the next decoded message.
+        :param timeout: Maximum time in seconds to wait. None waits until a message is available.
+        :return: Received message, None if no message was available within the timeout.
+        """
+        if not self.ordered:
+            data = self._get(timeout)
+
+        else:
+            deadline = time.time() + timeout if timeout is not None else None
+
+            while True:
+                if self.pending_messages:
+                    # All workers progressed past the oldest message - nothing older can arrive anymore.
+                    oldest_pulse_id = self.pending_messages[0][0]
+                    if len(self.pending_messages) > self.reorder_window or \
+                            all(pulse_id is not None and pulse_id >= oldest_pulse_id
+                                for pulse_id in self.worker_pulse_ids):
+                        break
+
+                remaining_time = deadline - time.time() if deadline is not None else None
+                if remaining_time is not None and remaining_time <= 0:
+                    break
+
+                # Idle workers do not hold back the messages longer than POLL_INTERVAL.
+                data = self._get(POLL_INTERVAL if remaining_time is None else min(POLL_INTERVAL, remaining_time))
+                if data is None:
+                    if self.pending_messages:
+                        break
+                    continue
+
+                heapq.heappush(self.pending_messages, (data.pulse_id, self.sequence_number, data))
+                self.sequence_number += 1
+
+            if not self.pending_messages:
+                return None
+
+            _, _, data = heapq.heappop(self.pending_messages)
+
+        if data is None:
+            return None
+
+        _restore_values(data)
+        return ReceivedMessage(self.statistics, data)
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, type, value, traceback):
+        self.disconnect()
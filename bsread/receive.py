@@ -1,88 +1,69 @@
 import click
 import mflow
-from bsread.handlers.compact import Handler
+from bsread.multi import MultiSource
 from bsread import dispatchers, utils
 import zmq
 import numpy
 
 
-def receive_many(sources, **kwargs):
-    receivers = []
-    for src in sources.values():
-        rec = receive(source=src, **kwargs)
-        receivers.append(rec)
-    for _ in zip(*receivers):
-        pass
-
-
-def receive(source=None, clear=False, queue_size=100, mode=zmq.PULL, channel_filter=None):
+def receive_many(sources, clear=False, queue_size=100, mode=zmq.PULL, channel_filter=None):
     numpy.set_printoptions(threshold=5)
     numpy.set_printoptions(linewidth=100)
 
-    print('Trying to connect to %s' % source)
-
-    receiver = mflow.connect(source, conn_type="connect", queue_size=queue_size, mode=mode, receive_timeout=10)
-    handler = Handler()
-
-    while True:
-        yield # use old-school coroutine approach to run several receives that take turns
-        message = receiver.receive(handler=handler.receive)
-        if message is None: # ran into timeout ...
-            continue        # ... try another receive
-
-        message = message.data  # As the rest of the code is only interested in the message data, not statistics
+    for src in sources.values():
+        print('Trying to connect to %s' % src)
 
-        # if message_data['header']['pulse_id'] % 10 == 0:
-        #     sys.stderr.write("\x1b[2J\x1b[H")
+    # Channels not in the filter are not decoded at all.
+    with MultiSource(sources, queue_size=queue_size, mode=mode, projection=channel_filter) as multi_source:
+        for _, message in multi_source:
+            # As the rest of the code is only interested in the message data, not statistics
+            print_message(message.data, clear=clear)
 
-        if clear:
-            print((chr(27) + "[2J"))
 
-        separator = '\t'
-        # separator = ', '
+def print_message(message, clear=False):
+    # if message_data['header']['pulse_id'] % 10 == 0:
+    #     sys.stderr.write("\x1b[2J\x1b[H")
 
-        if message.format_changed or clear:
-            # Have pulse_id, ... in first column
-            keys = "pulse_id" + separator + "global_timestamp" + separator + "global_timestamp_offset"
+    if clear:
+        print((chr(27) + "[2J"))
 
-            for key in message.data.keys():
+    separator = '\t'
+    # separator = ', '
 
-                if channel_filter and key not in channel_filter:
-                    # continue with next element as this one is not in the filter list
-                    continue
+    if message.format_changed or clear:
+        # Have pulse_id, ... in first column
+        keys = "pulse_id" + separator + "global_timestamp" + separator + "global_timestamp_offset"
 
-                if keys:
-                    keys = keys + separator + key
-                else:
-                    keys = key
+        for key in message.data.keys():
 
-            print(keys)
+            if keys:
+                keys = keys + separator + key
+            else:
+                keys = key
 
-        # pprint.pprint(message.data.values())
-        # Have pulse_id in first column
-        values = str(message.pulse_id) + separator + str(message.global_timestamp) + separator + str(
-            message.global_timestamp_offset)
+        print(keys)
 
-        for key in message.data.keys():
+    # pprint.pprint(message.data.values())
+    # Have pulse_id in first column
+    values = str(message.pulse_id) + separator + str(message.global_timestamp) + separator + str(
+        message.global_timestamp_offset)
 
-            if channel_filter and key not in channel_filter:
-                # continue with next element as this one is not in the filter list
-                continue
+    for key in message.data.keys():
 
-            value = message.data[key]
-            if values:
-                values = values + separator + str(value.value)
-            else:
-                values = str(value.value)
+        value = message.data[key]
+        if values:
+            values = values + separator + str(value.value)
+        else:
+            values = str(value.value)
 
-        # for value in message.data.values():
-        #
-        #     if values:
-        #         values = values + separator + str(value.value)
-        #     else:
-        #         values = str(value.value)
+    # for value in message.data.values():
+    #
+    #     if values:
+    #         values = values + separator + str(value.value)
+    #     else:
+    #         values = str(value.value)
 
-        print(values)
+    print(values)
 
 
 @click.command()
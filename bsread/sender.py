@@ -1,6 +1,9 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from threading import Lock
 
 import mflow
+import numpy
+import zmq
 import time
 import sys
 import hashlib
@@ -11,7 +14,8 @@ import logging
 from collections import OrderedDict
 
 from bsread.data.serialization import compression_provider_mapping
-from bsread.data.helpers import get_channel_specs, get_value_bytes, get_channel_encoding
+from bsread.data.helpers import get_channel_specs, get_value_bytes, get_channel_encoding, get_value_serializer, \
+    get_value_signature, tune_channel_compression, DEFAULT_MIN_COMPRESSION_RATIO
 
 PULL = mflow.PULL
 PUSH = mflow.PUSH
@@ -21,14 +25,21 @@ SUB = mflow.SUB
 CONNECT = "connect"
 BIND = "bind"
 
+# Values smaller than this (in bytes) are serialized inline - dispatching them to a thread costs more than compressing.
+DEFAULT_COMPRESSION_THRESHOLD = 64 * 1024
+
 
 # Support of "with" statement
 class sender:
     def __init__(self, queue_size=10, port=9999, conn_type=BIND, mode=PUSH, block=True, start_pulse_id=0,
-                 data_header_compression=None, data_compression=None, send_timeout=None, copy=True):
+                 data_header_compression=None, data_compression=None, send_timeout=None, copy=True,
+                 compression_workers=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 compression_tuning=False, reference_values=False):
         self.sender = Sender(queue_size=queue_size, port=port, conn_type=conn_type, mode=mode, block=block,
                              start_pulse_id=start_pulse_id, data_header_compression=data_header_compression,
-                             data_compression=data_compression, send_timeout=send_timeout, copy=copy)
+                             data_compression=data_compression, send_timeout=send_timeout, copy=copy,
+                             compression_workers=compression_workers, compression_threshold=compression_threshold,
+                             compression_tuning=compression_tuning, reference_values=reference_values)
 
     def __enter__(self):
         self.sender.open()
@@ -41,9 +52,13 @@ class sender:
 class Sender:
     def __init__(self, queue_size=10, port=9999, address="tcp://*", conn_type=BIND, mode=PUSH, block=True,
                  start_pulse_id=0, data_header_compression=None, send_timeout=None, data_compression=None,
-                 copy=True):
-
+                 copy=True, compression_workers=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 compression_tuning=False, reference_values=False):
         self.copy = copy
+
+        # Uncompressed arrays are passed to zmq by reference instead of being copied. Only safe if the sent arrays are
+        # not modified afterwards - zmq might still be sending them after send() returned (with copy=False).
+        self.reference_values = reference_values
         self.block = block
         self.queue_size = queue_size
         self.port = port
@@ -84,6 +99,17 @@ class Sender:
 
         self.status_stream_open = False
 
+        # Number of threads to serialize (compress) the channel values of a message in parallel.
+        # None or 0 serializes all values on the sending thread.
+        self.compression_workers = compression_workers
+        # Values smaller than this number of bytes are always serialized inline.
+        self.compression_threshold = compression_threshold
+        # Thread pool is started on first use (and again after close).
+        self.compression_executor = None
+
+        # Tune the compression of the channels whose metadata is determined from the sent values.
+        self.compression_tuning = compression_tuning
+
     def add_channel(self, name, function=None, metadata=None):
 
         if not metadata:
@@ -110,6 +136,9 @@ class Sender:
                                     conn_type=self.conn_type, mode=self.mode, no_client_action=no_client_action,
                                     no_client_timeout=no_client_timeout, copy=self.copy, send_timeout=self.send_timeout)
 
+        self._initialize_stream()
+
+    def _initialize_stream(self):
         # Main header
         self.main_header = dict()
         self.main_header['htype'] = "bsr_m-1.1"
@@ -136,9 +165,19 @@ class Sender:
 
     def close(self):
         self.stream.disconnect()
+        self._close_stream()
+
+    def _close_stream(self):
         self.status_stream_open = False
 
+        if self.compression_executor is not None:
+            self.compression_executor.shutdown()
+            self.compression_executor = None
+
     def add_channel_from_value(self, name, value):
+        self.channels[name] = Channel(None, self._get_metadata_from_value(name, value))
+
+    def _get_metadata_from_value(self, name, value):
         metadata = dict()
 
         metadata['name'] = name
@@ -148,7 +187,69 @@ class Sender:
         if self.data_compression is not None:
             metadata['compression'] = self.data_compression
 
-        self.channels[name] = Channel(None, metadata)
+            if self.compression_tuning:
+                tune_channel_compression(value, metadata)
+
+        return metadata
+
+    def tune_compression(self, data=None, min_compression_ratio=DEFAULT_MIN_COMPRESSION_RATIO):
+        """
+        Tune the compression (block size, or no compression at all) of the channels on representative data.
+        The result is stored in the channel metadata and therefore sent with the data header.
+        :param data: Representative data (channel name -> value), as passed to send. If not specified the values
+                     are retrieved from the functions registered with each channel.
+        :param min_compression_ratio: Minimal ratio (uncompressed/compressed size) to keep compressing a channel.
+        """
+        with self.channels_lock:
+
+            if data:
+                self._update_channels_from_values(list(data.keys()), list(data.values()))
+
+            for name, channel in self.channels.items():
+                if data:
+                    value = data[name]
+                elif channel.function:
+                    value = channel.function(self.pulse_id or self.start_pulse_id)
+                else:
+                    continue
+
+                tune_channel_compression(value, channel.metadata, min_compression_ratio)
+                # The serialization of the values depends on the metadata.
+                channel.value_signature = None
+
+            if self.status_stream_open:
+                self._create_data_header()
+
+    def _update_channels_from_values(self, names, values):
+        """
+        Update the channels to match the values to send. The metadata of a channel is only determined again if the
+        signature (type and shape) of its value changed since the last send.
+        :param names: Channel names.
+        :param values: Values to send, in the same order as the names.
+        :return: True if the channels (i.e. the data header) changed.
+        """
+        channels_changed = len(names) != len(self.channels) or any(a != b for a, b in zip(names, self.channels))
+
+        channels = OrderedDict()
+
+        for name, value in zip(names, values):
+            channel = self.channels.get(name)
+            value_signature = get_value_signature(value)
+
+            if channel is None or channel.metadata_signature != value_signature:
+                metadata = self._get_metadata_from_value(name, value)
+
+                if channel is None or channel.metadata != metadata:
+                    channel = Channel(None, metadata)
+                    channels_changed = True
+
+                channel.metadata_signature = value_signature
+
+            channels[name] = channel
+
+        self.channels = channels
+
+        return channels_changed
 
     def send(self, *args, timestamp=None, pulse_id=None, data=None, check_data=True,  **kwargs):
         """
@@ -157,6 +258,19 @@ class Sender:
             interval:   Interval in seconds to repeatedly execute this method
         """
 
+        # Lock the channel while sending data - prevent data corruption.
+        with self.channels_lock:
+            frames = self._create_message_frames(args, timestamp, pulse_id, data, check_data, kwargs)
+            self._send_frames(frames)
+
+        self._message_sent()
+
+    def _create_message_frames(self, args, timestamp, pulse_id, data, check_data, kwargs):
+        """
+        Create all frames of the next message - see send for the parameters. Needs to be called with the channels_lock.
+        :return: List of frames (bytes or objects supporting the buffer protocol). Values serialized on the thread
+                 pool are futures of their frame.
+        """
         if timestamp is None:
             timestamp = time.time()
 
@@ -176,79 +290,100 @@ class Sender:
         if pulse_id is not None:
             self.pulse_id = pulse_id
 
-        # Lock the channel while sending data - prevent data corruption.
-        with self.channels_lock:
-
-            if check_data:
-                logging.debug("Update channel metadata.")
-
-                if dict_data:
+        if check_data:
+            logging.debug("Update channel metadata.")
 
-                    self.channels = OrderedDict()
-
-                    for name, value in dict_data.items():
-                        self.add_channel_from_value(name, value)
+            # The data header is only recreated if the type or shape of a value changed.
+            if dict_data:
 
+                if self._update_channels_from_values(list(dict_data.keys()), list(dict_data.values())):
                     self._create_data_header()
 
-                elif list_data:
-                    if len(list_data) != len(self.channels):
-                        raise ValueError("Length of passed data (%d) does not correspond to configured channels (%d)"
-                                         % (len(list_data), len(self.channels)))
-
-                    # channels is Ordered dict, assumption is that channels are in the same order
-                    for index, name in enumerate(self.channels):
-                        self.add_channel_from_value(name, list_data[index])
+            elif list_data:
+                if len(list_data) != len(self.channels):
+                    raise ValueError("Length of passed data (%d) does not correspond to configured channels (%d)"
+                                     % (len(list_data), len(self.channels)))
 
+                # channels is Ordered dict, assumption is that channels are in the same order
+                if self._update_channels_from_values(list(self.channels.keys()), list_data):
                     self._create_data_header()
 
-            # Call pre function if registered
-            if self.pre_function:
-                self.pre_function()
+        # Call pre function if registered
+        if self.pre_function:
+            self.pre_function()
 
-            self.main_header['pulse_id'] = self.pulse_id
-            self.main_header['global_timestamp'] = {"sec": current_timestamp_epoch, "ns": current_timestamp_ns}
+        self.main_header['pulse_id'] = self.pulse_id
+        self.main_header['global_timestamp'] = {"sec": current_timestamp_epoch, "ns": current_timestamp_ns}
 
-            # Send headers
-            # Main header
-            self.stream.send(json.dumps(self.main_header).encode('utf-8'), send_more=True, block=self.block)
-            # Data header
-            self.stream.send(self.data_header_bytes, send_more=True, block=self.block)
+        # Assemble the whole message - main header, data header and (value, timestamp) frames per channel.
+        frames = [json.dumps(self.main_header).encode('utf-8'), self.data_header_bytes]
 
-            counter = 0
-            count = len(self.channels) - 1  # use of count to make value timestamps unique and to detect last item
-            for name, channel in self.channels.items():
-                if dict_data:
-                    value = dict_data[name]
-                elif list_data:
-                    value = list_data[counter]
-                else:
-                    value = channel.function(self.pulse_id)
+        # TODO: This timestamps should be individual per channel.
+        # All channels share the timestamp - pack it only once per endianness.
+        timestamps_bytes = {'<': struct.pack('<qq', current_timestamp_epoch, current_timestamp_ns),
+                            '>': struct.pack('>qq', current_timestamp_epoch, current_timestamp_ns)}
 
-                if value is None:
-                    self.stream.send(b'', send_more=True, block=self.block)
-                    self.stream.send(b'', send_more=(count > 0), block=self.block)
-                else:
-                    self.stream.send(get_value_bytes(value, channel.metadata.get("compression"),
-                                                     channel_type=channel.metadata.get("type")),
-                                     send_more=True, block=self.block)
+        for counter, (name, channel) in enumerate(self.channels.items()):
+            if dict_data:
+                value = dict_data[name]
+            elif list_data:
+                value = list_data[counter]
+            else:
+                value = channel.function(self.pulse_id)
+
+            if value is None:
+                frames.append(b'')
+                frames.append(b'')
+            else:
+                frames.append(self._serialize_value(channel, value))
 
-                    endianess = '>' if channel.metadata.get("encoding") == "big" else '<'
+                endianess = '>' if channel.metadata.get("encoding") == "big" else '<'
+                frames.append(timestamps_bytes[endianess])
 
-                    # TODO: This timestamps should be individual per channel.
-                    self.stream.send(struct.pack(endianess + 'q',
-                                                 current_timestamp_epoch) +
-                                     struct.pack(endianess + 'q',
-                                                 current_timestamp_ns), send_more=(count > 0), block=self.block)
-                count -= 1
-                counter += 1
+        return frames
 
+    def _message_sent(self):
         self.pulse_id += 1
 
         # Call post function if registered
         if self.post_function:
             self.post_function()
 
+    def _serialize_value(self, channel, value):
+        """
+        Serialize (and compress) the value of a channel - large arrays are serialized on the thread pool if configured.
+        :return: Bytes to send, or a future of them.
+        """
+        value_serializer = channel.get_value_serializer(value, copy=not self.reference_values)
+
+        if self.compression_workers and isinstance(value, numpy.ndarray) and \
+                value.nbytes >= self.compression_threshold:
+
+            if self.compression_executor is None:
+                self.compression_executor = ThreadPoolExecutor(max_workers=self.compression_workers)
+
+            return self.compression_executor.submit(value_serializer, value)
+
+        return value_serializer(value)
+
+    def _send_frames(self, frames):
+        """
+        Send all frames of a message with a single multipart send.
+        :param frames: Frames (bytes or objects supporting the buffer protocol, or futures of them) of the message.
+        """
+        # Wait for the values serialized on the thread pool - the frames keep their position in the message.
+        if self.compression_workers:
+            frames = [frame.result() if isinstance(frame, Future) else frame for frame in frames]
+
+        flags = 0 if self.block else zmq.NOBLOCK
+
+        try:
+            self.stream.socket.send_multipart(frames, flags, copy=self.copy)
+        except zmq.Again:
+            # Same as mflow - in non blocking mode messages that cannot be sent are dropped.
+            if self.block:
+                raise
+
     def generate_stream(self, n_messages=None, interval=0.01):
         """
         Send a continues stream of data.
@@ -277,3 +412,27 @@ class Channel:
         # metadata needs to contain: name, type (default: float64), encoding (default: little), shape (default [1])
         if 'encoding' not in self.metadata:
             self.metadata['encoding'] = sys.byteorder
+
+        # Signature of the value the metadata was determined from (None if the metadata was provided).
+        self.metadata_signature = None
+
+        # Serialization of the values - only determined again if the signature of the values changes.
+        self.value_signature = None
+        self.value_serializer = None
+
+    def get_value_serializer(self, value, copy=True):
+        """
+        Get the function to serialize and compress values like the provided one according to the channel metadata.
+        :param value: Value to send.
+        :param copy: If False, uncompressed arrays are not copied - the serialized value references the array.
+        :return: Function value -> bytes ready to be sent.
+        """
+        value_signature = get_value_signature(value)
+
+        if value_signature != self.value_signature:
+            self.value_serializer = get_value_serializer(value, self.metadata.get("compression"),
+                                                         channel_type=self.metadata.get("type"), copy=copy,
+                                                         block_size=self.metadata.get("compression_block_size"))
+            self.value_signature = value_signature
+
+        return self.value_serializer
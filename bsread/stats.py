@@ -133,7 +133,8 @@ def stats(channels, source, mode, clear, queue_size, base_url, backend, logfile,
 
     logger.info(f"Connecting to {source}")
     receiver = mflow.connect(source, conn_type="connect", queue_size=queue_size, mode=mode)
-    handler = Handler()
+    # Most messages are only checked for their pulse_id - only decode values when they are displayed.
+    handler = Handler(lazy=True)
     logger.info("Connection opened")
 
     messages_received = 0
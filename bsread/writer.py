@@ -1,5 +1,12 @@
 import h5py
 import logging
+import struct
+import time
+from threading import Thread
+
+import numpy
+
+from bsread.background import RingBuffer, BLOCK, POLL_INTERVAL
 
 logger = logging.getLogger(__name__)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -7,12 +14,122 @@ logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(name)s - %(mes
 
 # The latest h5py user manual is available at - http://docs.h5py.org/en/latest/
 
+# Dataset compression filters.
+COMPRESSION_LZF = "lzf"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_BITSHUFFLE_LZ4 = "bitshuffle_lz4"
+
+COMPRESSIONS = [COMPRESSION_LZF, COMPRESSION_GZIP, COMPRESSION_BITSHUFFLE_LZ4]
+
+# Maximum size of a chunk in bytes - a chunk holds at least one row (e.g. a whole image) though.
+DEFAULT_CHUNK_BYTES = 1024 * 1024
+# Rows per chunk if the expected message rate is not known.
+DEFAULT_CHUNK_ROWS = 1000
+
+# Buffered mode - collected rows are written at least this often (in seconds), also at low message rates.
+DEFAULT_FLUSH_INTERVAL = 5
+
+# Full datasets grow by this factor - but at least by MIN_GROWTH_ROWS rows.
+DEFAULT_GROWTH_FACTOR = 2
+MIN_GROWTH_ROWS = 1000
+
+
+def get_chunk_shape(shape, dtype, rate=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Get the chunk shape of a dataset. A chunk contains whole rows (messages), at most one second of data and at most
+    chunk_bytes.
+    :param shape: Shape of the dataset - first dimension are the messages.
+    :param dtype: Type of the dataset.
+    :param rate: Expected message rate in Hz. None uses DEFAULT_CHUNK_ROWS rows per chunk.
+    :param chunk_bytes: Maximum size of a chunk in bytes.
+    :return: Chunk shape.
+    """
+    row_shape = tuple(shape[1:])
+    row_bytes = numpy.dtype(dtype).itemsize * int(numpy.prod(row_shape))
+
+    # Rows without data (e.g. empty waveforms) - the size limit does not apply, one row per chunk.
+    if row_bytes == 0:
+        return (1,) + row_shape
+
+    n_rows = int(rate) if rate else DEFAULT_CHUNK_ROWS
+    n_rows = max(min(n_rows, chunk_bytes // row_bytes), 1)
+
+    return (n_rows,) + row_shape
+
+
+def get_filter_options(compression, dtype, compression_level=None, shuffle=False):
+    """
+    Get the h5py dataset options for the given compression.
+    :param compression: COMPRESSION_LZF, COMPRESSION_GZIP, COMPRESSION_BITSHUFFLE_LZ4 or None.
+    :param dtype: Type of the dataset.
+    :param compression_level: Compression level for gzip (0-9, default 4).
+    :param shuffle: Apply the HDF5 byte shuffle filter before compression (lzf and gzip).
+    :return: Dictionary of options for h5py create_dataset.
+    """
+    if compression is None:
+        return {}
+
+    # Variable length strings are stored on the heap - only the references would be shuffled.
+    variable_length = numpy.dtype(dtype).kind == 'O'
+
+    if compression == COMPRESSION_BITSHUFFLE_LZ4:
+        if variable_length:
+            return {}
+
+        # Importing the module registers the bitshuffle filter plugin with HDF5.
+        import bitshuffle.h5
+        return {"compression": bitshuffle.h5.H5FILTER, "compression_opts": (0, bitshuffle.h5.H5_COMPRESS_LZ4)}
+
+    if compression not in COMPRESSIONS:
+        raise ValueError("Compression '%s' not supported. Available: %s" % (compression, COMPRESSIONS))
+
+    options = {"compression": compression, "shuffle": shuffle and not variable_length}
+
+    if compression == COMPRESSION_GZIP and compression_level is not None:
+        options["compression_opts"] = compression_level
+
+    return options
+
 
 class Writer:
-    def __init__(self):
+    def __init__(self, buffer_size=None, flush_interval=None, max_buffer_bytes=None, compression=None,
+                 compression_level=None, shuffle=False, rate=None, chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 expected_messages=None, growth_factor=DEFAULT_GROWTH_FACTOR):
+        """
+        :param buffer_size: Buffered mode - number of rows collected per dataset before they are written with one
+                            HDF5 write (rounded up to a multiple of the dataset chunk size if it is larger than a
+                            chunk). None (default) writes every row immediately.
+        :param flush_interval: Buffered mode - write the collected rows at least every flush_interval seconds (e.g.
+                               DEFAULT_FLUSH_INTERVAL). None (default) only writes full buffers.
+        :param max_buffer_bytes: Buffered mode - write the collected rows if they exceed this number of bytes.
+        :param compression: Compression of the datasets: COMPRESSION_LZF, COMPRESSION_GZIP, COMPRESSION_BITSHUFFLE_LZ4
+                            or None (default).
+        :param compression_level: Compression level for gzip.
+        :param shuffle: Apply the HDF5 byte shuffle filter before lzf or gzip compression.
+        :param rate: Expected message rate in Hz - a chunk holds at most one second of data.
+        :param chunk_bytes: Maximum size of a chunk in bytes.
+        :param expected_messages: Expected number of rows - the datasets are created with this size up front.
+        :param growth_factor: Full datasets grow by this factor (at least by MIN_GROWTH_ROWS rows).
+        """
         self.file = None
         self.dataset_groups = {}
 
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_buffer_bytes = max_buffer_bytes
+
+        self.buffered_bytes = 0
+        self.last_flush_time = time.time()
+
+        self.compression = compression
+        self.compression_level = compression_level
+        self.shuffle = shuffle
+        self.rate = rate
+        self.chunk_bytes = chunk_bytes
+
+        self.expected_messages = expected_messages
+        self.growth_factor = growth_factor
+
     def open_file(self, file_name):
 
         if self.file:
@@ -23,12 +140,14 @@ class Writer:
         self.file = h5py.File(file_name, "w")
 
     def close_file(self):
+        self.flush()
         self.compact_data()
 
         logger.info('Close file '+self.file.name)
         self.file.close()
 
-    def add_dataset(self, dataset_name, dataset_group_name='data', shape=(1,), dtype="i8", maxshape=(None,), **kwargs):
+    def add_dataset(self, dataset_name, dataset_group_name='data', shape=(1,), dtype="i8", maxshape=(None,),
+                    direct_chunk=False, **kwargs):
         """
         Add and create a dataset to the writer.
         :param dataset_group_name: The group the this dataset belongs to.
@@ -38,19 +157,22 @@ class Writer:
                         http://docs.scipy.org/doc/numpy/user/basics.types.html
                         http://docs.scipy.org/doc/numpy/user/basics.rec.html#defining-structured-arrays
         :param maxshape:
-        :param kwargs:
+        :param direct_chunk: The values are written as bitshuffle_lz4 compressed chunks (raw bytes as received), one
+                             row per chunk - see write_chunk.
+        :param kwargs: Additional h5py dataset options - chunks and compression options override the ones of the writer.
         :return:
         """
 
         if dataset_group_name not in self.dataset_groups:
             self.dataset_groups[dataset_group_name] = DatasetGroup()
 
-        dataset = self.file.require_dataset(dataset_name, shape, dtype=dtype, maxshape=maxshape, **kwargs)
-        # chunks=True, shuffle=True, compression="lzf")
-        self.dataset_groups[dataset_group_name].datasets.append(Dataset(dataset_name, dataset))
+        dataset = Dataset(dataset_name, None)
+        self._create_dataset(dataset, shape, dtype, maxshape, direct_chunk, kwargs)
+
+        self.dataset_groups[dataset_group_name].datasets.append(dataset)
 
     def replace_dataset(self, dataset_group_name='data', dataset_name="dataset_stub",
-                        shape=(1,), dtype="i8", maxshape=(None,), **kwargs):
+                        shape=(1,), dtype="i8", maxshape=(None,), direct_chunk=False, **kwargs):
         """
         Replace an existing dataset in the writer.
         :param dataset_group_name: The group the this dataset belongs to.
@@ -60,7 +182,8 @@ class Writer:
                         http://docs.scipy.org/doc/numpy/user/basics.types.html
                         http://docs.scipy.org/doc/numpy/user/basics.rec.html#defining-structured-arrays
         :param maxshape:
-        :param kwargs:
+        :param direct_chunk: The values are written as compressed chunks (see add_dataset).
+        :param kwargs: Additional h5py dataset options - chunks and compression options override the ones of the writer.
         :return:
         """
 
@@ -75,6 +198,7 @@ class Writer:
                              dataset_name, dataset_group_name)
 
         if dataset.reference is not None:
+            self.flush_dataset(dataset)
             self.compact_dataset(dataset)
 
             for index in range(1, 100):
@@ -88,8 +212,41 @@ class Writer:
             else:
                 raise ValueError("Dataset '%s' replaced more then 100 times. Something is wrong?", dataset_name)
 
-        dataset.reference = self.file.require_dataset(dataset_name, shape, dtype=dtype, maxshape=maxshape, **kwargs)
-        dataset.reference.resize(dataset.count + 1000, axis=0)
+        self._create_dataset(dataset, shape, dtype, maxshape, direct_chunk, kwargs)
+        self.grow_dataset(dataset, dataset.count + 1)
+
+        # The buffer needs to match the new dataset.
+        dataset.buffer = None
+
+    def _create_dataset(self, dataset, shape, dtype, maxshape, direct_chunk, kwargs):
+        if direct_chunk:
+            # One row per chunk - exactly the size of one received value.
+            options = get_filter_options(COMPRESSION_BITSHUFFLE_LZ4, dtype)
+            options["chunks"] = (1,) + tuple(shape[1:])
+            options.update(kwargs)
+        else:
+            options = self._get_dataset_options(shape, dtype, kwargs)
+
+        dataset.reference = self.file.require_dataset(dataset.name, shape, dtype=dtype, maxshape=maxshape, **options)
+
+        dataset.direct_chunk = direct_chunk
+
+        # Preallocate the expected rows - ideally the dataset is never resized until it is compacted.
+        if self.expected_messages:
+            self.grow_dataset(dataset, self.expected_messages)
+        dataset.chunk_bytes = dataset.reference.dtype.itemsize * int(numpy.prod(shape[1:]))
+
+    def _get_dataset_options(self, shape, dtype, kwargs):
+        # Compression given for this dataset replaces all filter options of the writer.
+        if "compression" in kwargs:
+            options = {}
+        else:
+            options = get_filter_options(self.compression, dtype, self.compression_level, self.shuffle)
+
+        options["chunks"] = get_chunk_shape(shape, dtype, self.rate, self.chunk_bytes)
+
+        options.update(kwargs)
+        return options
 
     def add_dataset_stub(self, dataset_group_name='data', dataset_name="dataset_stub"):
 
@@ -113,19 +270,112 @@ class Writer:
         if len(data) != len(dataset_group.datasets):
             raise RuntimeError('The size of the passed data object does not match the size of datasets configured')
 
+        if self.buffer_size:
+            self._buffer(data, dataset_group)
+            return
+
         # Write to dataset
         for index, dataset in enumerate(dataset_group.datasets):
             if dataset:  # Check for dataset stub, i.e. None
-                required_size = dataset.count + 1
-                if dataset.reference.shape[0] < required_size:
-                    dataset.reference.resize(dataset.count + 1000, axis=0)
+                self.grow_dataset(dataset, dataset.count + 1)
                 # TODO need to add an None check - i.e. for different frequencies
                 # ADD else clause
                 if data is not None and data[index] is not None:
-                    dataset.reference[dataset.count] = data[index]
+                    if dataset.direct_chunk:
+                        self.write_chunk(dataset, data[index])
+                    else:
+                        dataset.reference[dataset.count] = data[index]
 
             dataset.count += 1
 
+    def _buffer(self, data, dataset_group):
+        for index, dataset in enumerate(dataset_group.datasets):
+            if dataset and dataset.direct_chunk:
+                # Compressed chunks are written as they are - there is nothing to collect.
+                self.grow_dataset(dataset, dataset.count + 1)
+
+                if data is not None and data[index] is not None:
+                    self.write_chunk(dataset, data[index])
+
+                dataset.count += 1
+
+            elif dataset:  # Check for dataset stub, i.e. None
+                if dataset.buffer is None:
+                    dataset.create_buffer(self.buffer_size)
+
+                value = data[index] if data is not None else None
+                dataset.buffer[dataset.buffer_count] = value if value is not None else dataset.fill_value
+                dataset.buffer_count += 1
+                dataset.count += 1
+
+                self.buffered_bytes += dataset.buffer_row_bytes
+
+                if dataset.buffer_count == len(dataset.buffer):
+                    self.flush_dataset(dataset)
+
+            else:
+                dataset.count += 1
+
+        if (self.max_buffer_bytes and self.buffered_bytes >= self.max_buffer_bytes) or \
+                (self.flush_interval and time.time() - self.last_flush_time >= self.flush_interval):
+            self.flush()
+
+    @staticmethod
+    def write_chunk(dataset, raw_chunk):
+        """
+        Write a bitshuffle_lz4 compressed value (raw bytes as received - the bsread compression header is the header
+        of the HDF5 bitshuffle filter) as chunk of the current row, without decompressing it.
+        :param dataset: Dataset created with direct_chunk.
+        :param raw_chunk: Compressed bytes.
+        """
+        # The header starts with the uncompressed size - a chunk of another size would not be readable.
+        n_bytes = struct.unpack_from(">Q", raw_chunk)[0]
+        if n_bytes != dataset.chunk_bytes:
+            logger.warning("Skip chunk of %d bytes for dataset %s, expected %d bytes." %
+                           (n_bytes, dataset.name, dataset.chunk_bytes))
+            return
+
+        offset = (dataset.count,) + (0,) * (len(dataset.reference.shape) - 1)
+        dataset.reference.id.write_direct_chunk(offset, raw_chunk)
+
+    def flush(self):
+        """Write the buffered rows of all datasets."""
+
+        for dataset_group in self.dataset_groups.values():
+            for dataset in dataset_group.datasets:
+                self.flush_dataset(dataset)
+
+        self.buffered_bytes = 0
+        self.last_flush_time = time.time()
+
+    def flush_dataset(self, dataset):
+        """Write the buffered rows of the dataset with one HDF5 write."""
+
+        if not dataset or not dataset.buffer_count:
+            return
+
+        start = dataset.count - dataset.buffer_count
+        self.grow_dataset(dataset, dataset.count)
+
+        dataset.reference[start:dataset.count] = dataset.buffer[:dataset.buffer_count]
+
+        self.buffered_bytes = max(self.buffered_bytes - dataset.buffer_count * dataset.buffer_row_bytes, 0)
+        dataset.buffer_count = 0
+
+    def grow_dataset(self, dataset, n_rows):
+        """
+        Make sure the dataset has at least n_rows rows. A full dataset grows geometrically (by growth_factor, at least
+        by MIN_GROWTH_ROWS rows) - long recordings need only few resizes.
+        :param dataset: Dataset to grow.
+        :param n_rows: Minimal number of rows.
+        """
+        size = dataset.reference.shape[0]
+        if size >= n_rows:
+            return
+
+        new_size = max(n_rows, int(size * self.growth_factor), size + MIN_GROWTH_ROWS, self.expected_messages or 0)
+        dataset.reference.resize(new_size, axis=0)
+
     def compact_data(self):
         """Compact datasets, i.e. shrink them to actual size"""
 
@@ -149,6 +399,39 @@ class Dataset:
         self.count = count
         self.reference = dataset_reference
 
+        # Buffered mode - rows not yet written to the dataset (the last buffer_count rows before count).
+        self.buffer = None
+        self.buffer_count = 0
+        self.buffer_row_bytes = 0
+        self.fill_value = None
+
+        # Values are written as compressed chunks, one row per chunk - chunk_bytes uncompressed.
+        self.direct_chunk = False
+        self.chunk_bytes = 0
+
+    def create_buffer(self, buffer_size):
+        """
+        Create the buffer for the rows of the dataset - a buffer larger than a chunk is rounded up to a multiple of
+        the dataset chunk size, to write whole chunks.
+        :param buffer_size: Minimal number of rows in the buffer.
+        """
+        chunk_rows = min(self.reference.chunks[0] if self.reference.chunks else 1, buffer_size)
+        n_rows = -(-buffer_size // chunk_rows) * chunk_rows
+
+        dtype = self.reference.dtype
+        row_shape = self.reference.shape[1:]
+
+        # Variable length strings.
+        if dtype.kind == 'O':
+            self.fill_value = ''
+            self.buffer_row_bytes = 8
+        else:
+            self.fill_value = self.reference.fillvalue
+            self.buffer_row_bytes = dtype.itemsize * int(numpy.prod(row_shape))
+
+        self.buffer = numpy.full((n_rows,) + row_shape, self.fill_value, dtype=dtype)
+        self.buffer_count = 0
+
     def __bool__(self):
         return self.reference is not None
 
@@ -158,6 +441,142 @@ class DatasetGroup:
         self.datasets = []
 
 
+class WriterThread:
+    """
+    Run a writer on a dedicated thread - HDF5 stalls (e.g. metadata flushes on a slow file system) do not block the
+    receiving anymore. The writer calls of a message are collected and passed as a unit through a bounded queue, the
+    writer thread executes them in order. Same interface as the Writer:
+
+        writer = WriterThread(Writer(), queue_size=1000).start()
+        writer.open_file('test.h5')
+        writer.add_dataset('/test/data')
+        writer.write([1])
+        writer.end_message()
+        writer.close_file()
+    """
+
+    def __init__(self, writer, queue_size=1000, drop_messages=False):
+        """
+        :param writer: Writer to run on the thread.
+        :param queue_size: Maximum number of messages waiting to be written.
+        :param drop_messages: If the queue is full, drop the message instead of waiting until there is space again.
+                              Only messages that just write values are dropped (not ones that add datasets).
+        """
+        self.writer = writer
+        self.drop_messages = drop_messages
+
+        self.buffer = RingBuffer(queue_size, BLOCK)
+
+        # Calls (method name, args, kwargs) of the current message.
+        self.calls = []
+
+        self.messages_dropped = 0
+        # Time in seconds the caller waited for space in the queue.
+        self.stall_time = 0.0
+        self.error = None
+
+        self.thread = None
+
+    @property
+    def queue_depth(self):
+        return self.buffer.depth
+
+    @property
+    def max_queue_depth(self):
+        return self.buffer.max_depth
+
+    def start(self):
+        self.thread = Thread(target=self._write_messages, name="bsread-writer", daemon=True)
+        self.thread.start()
+
+        return self
+
+    def open_file(self, *args, **kwargs):
+        self.calls.append(("open_file", args, kwargs))
+
+    def add_dataset(self, *args, **kwargs):
+        self.calls.append(("add_dataset", args, kwargs))
+
+    def replace_dataset(self, *args, **kwargs):
+        self.calls.append(("replace_dataset", args, kwargs))
+
+    def add_dataset_stub(self, *args, **kwargs):
+        self.calls.append(("add_dataset_stub", args, kwargs))
+
+    def write(self, *args, **kwargs):
+        self.calls.append(("write", args, kwargs))
+
+    def flush(self):
+        self.calls.append(("flush", (), {}))
+
+    def end_message(self):
+        """
+        Pass the calls of the current message to the writer thread.
+        """
+        if not self.calls:
+            return
+
+        calls = self.calls
+        self.calls = []
+
+        self._check_error()
+
+        # Try without waiting first - to only measure the time really spent waiting for space.
+        if self.buffer.put(calls, timeout=0):
+            return
+
+        if self.drop_messages and all(name == "write" for name, _, _ in calls):
+            self.messages_dropped += 1
+            return
+
+        start_time = time.time()
+        while not self.buffer.put(calls, timeout=POLL_INTERVAL):
+            self._check_error()
+        self.stall_time += time.time() - start_time
+
+    def close_file(self):
+        """
+        Write all queued messages, close the file (see Writer.close_file) and stop the writer thread.
+        """
+        try:
+            self.end_message()
+        finally:
+            self.buffer.put(None)
+
+            self.thread.join()
+            self.thread = None
+
+        self._check_error()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError("Writing failed.") from self.error
+
+    def _write_messages(self):
+        try:
+            while True:
+                calls = self.buffer.get()
+
+                # Close requested.
+                if calls is None:
+                    break
+
+                for name, args, kwargs in calls:
+                    getattr(self.writer, name)(*args, **kwargs)
+
+        except Exception as e:
+            logger.exception("Writing failed.")
+            self.error = e
+
+            # Unblock the caller - all further messages are discarded.
+            while self.buffer.get() is not None:
+                pass
+
+        finally:
+            if self.writer.file:
+                self.writer.close_file()
+
+
 # Example writer
 if __name__ == "__main__":
     writer = Writer()
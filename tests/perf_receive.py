@@ -0,0 +1,170 @@
+import argparse
+import json
+import tracemalloc
+from time import perf_counter
+from unittest import mock
+
+import numpy
+
+from bsread.handlers import compact, extended
+from bsread.sender import Sender
+
+# Channel mixes to benchmark: name -> function(compression) returning the data to send (channel name -> value).
+channel_mixes = {
+    "scalars": lambda: {"SCALAR-%03d" % index: float(index) for index in range(500)},
+    "waveforms": lambda: {"WAVEFORM-%02d" % index: numpy.random.rand(2048) for index in range(20)},
+    "images": lambda: {"IMAGE-%d" % index: numpy.random.randint(0, 4096, size=(1024, 1024), dtype=numpy.uint16)
+                       for index in range(4)},
+    "strings": lambda: {"STRING-%03d" % index: "value of channel %d" % index for index in range(100)},
+    "mixed": lambda: dict(**{"SCALAR-%03d" % index: float(index) for index in range(200)},
+                          **{"WAVEFORM-%02d" % index: numpy.random.rand(2048) for index in range(10)},
+                          **{"STRING-%02d" % index: "value of channel %d" % index for index in range(10)},
+                          IMAGE=numpy.random.randint(0, 4096, size=(1024, 1024), dtype=numpy.uint16))
+}
+
+compressions = [None, "bitshuffle_lz4"]
+
+
+class RecordingStream:
+    """
+    In-memory replacement of the mflow stream for the sender - records all sent frames.
+    """
+    def __init__(self):
+        self.messages = []
+
+        # The sender sends whole messages directly on the socket.
+        self.socket = self
+
+    def send_multipart(self, frames, flags=0, copy=True):
+        self.messages.append([bytes(frame) for frame in frames])
+
+    def disconnect(self):
+        pass
+
+
+class ReplayReceiver:
+    """
+    In-memory replacement of the mflow receiver for the handlers - replays recorded frames.
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+
+    def reset(self, frames=None):
+        if frames is not None:
+            self.frames = frames
+        self.index = 0
+
+    def next(self, as_json=False):
+        frame = self.frames[self.index]
+        self.index += 1
+        return json.loads(frame) if as_json else frame
+
+    def has_more(self):
+        return self.index < len(self.frames)
+
+
+def create_sender(compression, sender_options):
+    stream = RecordingStream()
+
+    with mock.patch("bsread.sender.mflow.connect", return_value=stream):
+        sender = Sender(data_compression=compression, **sender_options)
+        sender.open()
+
+    return sender, stream
+
+
+def measure(function, n_messages):
+    """
+    Call function n_messages times.
+    :return: Tuple (seconds per call, peak traced memory per call in bytes)
+    """
+    # Warm up - e.g. to setup the channel definitions.
+    function()
+
+    start_time = perf_counter()
+    for _ in range(n_messages):
+        function()
+    duration = (perf_counter() - start_time) / n_messages
+
+    tracemalloc.start()
+    function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return duration, peak_memory
+
+
+def print_result(name, mix, compression, n_channels, n_bytes, duration, peak_memory):
+    print("%-10s %-10s %-15s %10.1f msg/s %10.1f MB/s %10.0f ns/channel %12.1f KB peak/msg" %
+          (name, mix, compression, 1 / duration, n_bytes / duration / 1024 / 1024,
+           duration / n_channels * 1e9, peak_memory / 1024))
+
+
+def run_benchmark(mix, compression, n_messages, handler_options, sender_options):
+    data = channel_mixes[mix]()
+    n_channels = len(data)
+
+    # Sender
+    sender, stream = create_sender(compression, sender_options)
+
+    def send():
+        sender.send(data=data)
+        stream.messages.clear()
+
+    duration, peak_memory = measure(send, n_messages)
+
+    sender.send(data=data)
+    frames = stream.messages[-1]
+    n_bytes = sum(len(frame) for frame in frames)
+
+    print_result("send", mix, str(compression), n_channels, n_bytes, duration, peak_memory)
+
+    # Handlers - the data header is only sent with the first message of the benchmark (as with a real stream).
+    handlers = [("compact", compact.Handler(**handler_options))]
+
+    # Lazy decoding is only supported by the compact handler.
+    if not handler_options.get("lazy"):
+        handlers.append(("extended", extended.Handler(decode_workers=handler_options.get("decode_workers"))))
+
+    for name, handler in handlers:
+        receiver = ReplayReceiver(frames)
+
+        def receive():
+            receiver.reset()
+            handler.receive(receiver)
+
+        duration, peak_memory = measure(receive, n_messages)
+
+        print_result(name, mix, str(compression), n_channels, n_bytes, duration, peak_memory)
+
+        handler.close()
+
+    sender.close()
+
+
+def run_benchmarks(mixes, n_messages, handler_options, sender_options):
+    print("Benchmark parameters: n_messages: %d; handler options: %s; sender options: %s" %
+          (n_messages, handler_options, sender_options))
+
+    for mix in mixes:
+        for compression in compressions:
+            run_benchmark(mix, compression, n_messages, handler_options, sender_options)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark sending and receiving (decoding) of bsread messages '
+                                                 'without network.')
+
+    parser.add_argument("-n", "--n_messages", type=int, default=100, help="Number of messages per benchmark.")
+    parser.add_argument("-m", "--mix", choices=list(channel_mixes.keys()), action="append",
+                        help="Channel mix to benchmark (default: all).")
+    parser.add_argument("--decode_workers", type=int, default=None, help="Parallel decode threads (compact handler).")
+    parser.add_argument("--lazy", action="store_true", help="Lazy decoding (compact handler only - the extended "
+                                                               "handler is not benchmarked).")
+    parser.add_argument("--compression_workers", type=int, default=None, help="Parallel compression threads (sender).")
+    inputs = parser.parse_args()
+
+    run_benchmarks(inputs.mix or list(channel_mixes.keys()), inputs.n_messages,
+                   {"decode_workers": inputs.decode_workers, "lazy": inputs.lazy},
+                   {"compression_workers": inputs.compression_workers})
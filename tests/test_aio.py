@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+
+import numpy
+
+from bsread.aio import AsyncSource, AsyncSender
+from bsread.sender import sender
+
+
+class TestAsync(unittest.IsolatedAsyncioTestCase):
+
+    async def test_send_receive(self):
+        async with AsyncSource(host="localhost", port=9999) as receive_stream:
+            async with AsyncSender(port=9999) as send_stream:
+                for index in range(3):
+                    await send_stream.send(data={"scalar": float(index), "array": numpy.arange(16) + index})
+
+                messages = []
+                async for message in receive_stream:
+                    messages.append(message)
+                    if len(messages) == 3:
+                        break
+
+        self.assertEqual([message.data.pulse_id for message in messages], [0, 1, 2])
+        self.assertEqual([message.data.data["scalar"].value for message in messages], [0.0, 1.0, 2.0])
+        numpy.testing.assert_array_equal(messages[2].data.data["array"].value, numpy.arange(16) + 2)
+        self.assertEqual(receive_stream.statistics.messages_received, 3)
+
+    async def test_receive_cancel(self):
+        async with AsyncSource(host="localhost", port=9999, copy=False) as receive_stream:
+
+            # Cancelled receive does not lose the next message.
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(receive_stream.receive(), 0.1)
+
+            with sender(port=9999) as send_stream:
+                send_stream.send(data={"image": numpy.ones((64, 64), dtype="u2")})
+
+                message = await asyncio.wait_for(receive_stream.receive(), 10)
+
+        numpy.testing.assert_array_equal(message.data.data["image"].value, numpy.ones((64, 64), dtype="u2"))
+
+    async def test_concurrent_send(self):
+        image = numpy.arange(256 * 256, dtype="u2").reshape((256, 256))
+
+        async with AsyncSource(host="localhost", port=9999) as receive_stream:
+            async with AsyncSender(port=9999, data_compression="bitshuffle_lz4", compression_workers=2,
+                                   compression_threshold=0) as send_stream:
+                # Each send gets its own pulse_id, the messages are sent in pulse_id order.
+                await asyncio.gather(*[send_stream.send(data={"image": image + index, "scalar": index})
+                                       for index in range(5)])
+
+                messages = [await asyncio.wait_for(receive_stream.receive(), 10) for _ in range(5)]
+
+        self.assertEqual([message.data.pulse_id for message in messages], list(range(5)))
+        self.assertEqual([message.data.data["scalar"].value for message in messages], list(range(5)))
+        numpy.testing.assert_array_equal(messages[3].data.data["image"].value, image + 3)
+
+    async def test_receive_batch(self):
+        async with AsyncSource(host="localhost", port=9999) as receive_stream:
+            async with AsyncSender(port=9999) as send_stream:
+                for index in range(3):
+                    await send_stream.send(data={"scalar": float(index)})
+
+                batch = await receive_stream.receive_batch(5, timeout=0.5)
+
+        self.assertEqual(batch.size, 3)
+        numpy.testing.assert_array_equal(batch.pulse_id, [0, 1, 2])
+        numpy.testing.assert_array_equal(batch.data["scalar"].value, [0.0, 1.0, 2.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import time
+import unittest
+
+from bsread import source
+from bsread.background import BackgroundReceiver, RingBuffer, DROP_OLDEST, DROP_NEWEST, BLOCK
+from bsread.sender import sender
+
+
+class TestBackground(unittest.TestCase):
+
+    def test_ring_buffer(self):
+        buffer = RingBuffer(2, DROP_OLDEST)
+        for item in range(3):
+            self.assertTrue(buffer.put(item))
+        self.assertEqual([buffer.get(0), buffer.get(0), buffer.get(0)], [1, 2, None])
+        self.assertEqual(buffer.dropped, 1)
+        self.assertEqual(buffer.max_depth, 2)
+
+        buffer = RingBuffer(2, DROP_NEWEST)
+        self.assertEqual([buffer.put(item) for item in range(3)], [True, True, False])
+        self.assertEqual([buffer.get(0), buffer.get(0)], [0, 1])
+        self.assertEqual(buffer.dropped, 1)
+
+        buffer = RingBuffer(1, BLOCK)
+        self.assertTrue(buffer.put(0))
+        self.assertFalse(buffer.put(1, timeout=0.1))
+        self.assertEqual(buffer.dropped, 0)
+
+        with self.assertRaises(ValueError):
+            RingBuffer(1, "unknown")
+
+    def test_background_receive(self):
+        with source(host="localhost", port=9999) as receive_stream:
+            with BackgroundReceiver(receive_stream, buffer_size=3, overflow=DROP_OLDEST) as receiver:
+                with sender(port=9999) as send_stream:
+                    for index in range(5):
+                        send_stream.send(data={"A": index})
+
+                    # Messages are received while the consumer is busy.
+                    deadline = time.time() + 10
+                    while receiver.messages_received < 5 and time.time() < deadline:
+                        time.sleep(0.05)
+
+                    self.assertEqual(receiver.queue_depth, 3)
+                    self.assertEqual(receiver.messages_dropped, 2)
+
+                    messages = [receiver.receive(timeout=1) for _ in range(3)]
+                    self.assertIsNone(receiver.receive(timeout=0.1))
+
+        self.assertEqual([message.data.data["A"].value for message in messages], [2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
 import unittest
 import logging
 
-from bsread.data.helpers import get_value_reader
+from bsread.data.helpers import get_value_reader, get_serialization_type
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -78,6 +78,248 @@ class TestGenerator(unittest.TestCase):
                 print(message.data.data['one'].value)
                 # message = in_stream.receive(filter=filter_method)
 
+    def test_receive_batch(self):
+        from bsread import source
+        from bsread.sender import sender
+        import numpy
+
+        with source(host="localhost", port=9999, receive_timeout=1000) as in_stream:
+
+            with sender(queue_size=10) as stream:
+
+                for pulse_id in range(3):
+                    stream.send(pulse_id=pulse_id, one=pulse_id, two=[1.0, 2.0, 3.0], three="text")
+
+                # Data header changes - the batch needs to be cut before this message.
+                stream.send(pulse_id=3, one=3, four=4.0)
+
+                batch = in_stream.receive_batch(10, timeout=0.5)
+
+                self.assertEqual(len(batch), 3)
+                numpy.testing.assert_array_equal(batch.pulse_id, [0, 1, 2])
+                numpy.testing.assert_array_equal(batch.data["one"].value, [0, 1, 2])
+                numpy.testing.assert_array_equal(batch.data["one"].pulse_id, [0, 1, 2])
+                self.assertTrue(batch.data["one"].valid.all())
+                self.assertEqual(batch.data["two"].value.shape, (3, 3))
+                self.assertListEqual(list(batch.data["three"].value), ["text"] * 3)
+
+                batch = in_stream.receive_batch(10, timeout=0.5)
+
+                self.assertEqual(len(batch), 1)
+                self.assertListEqual(list(batch.data.keys()), ["one", "four"])
+                self.assertEqual(batch.data["four"].value[0], 4.0)
+
+                self.assertIsNone(in_stream.receive_batch(10, timeout=0.1))
+
+    def test_receive_batch_mixed(self):
+        from bsread import source
+        from bsread.sender import sender
+
+        with source(host="localhost", port=9999, receive_timeout=1000) as in_stream:
+
+            with sender(queue_size=10) as stream:
+
+                for pulse_id in range(2):
+                    stream.send(pulse_id=pulse_id, one=pulse_id)
+
+                # Data header changes - this message ends the batch.
+                stream.send(pulse_id=2, one=2, four=4.0)
+                stream.send(pulse_id=3, one=3, four=4.0)
+
+                batch = in_stream.receive_batch(10, timeout=0.5)
+                self.assertEqual(len(batch), 2)
+
+                # The message that ended the batch is not lost and comes first.
+                self.assertEqual(in_stream.receive().data.pulse_id, 2)
+                self.assertEqual(in_stream.receive().data.pulse_id, 3)
+
+    def test_receive_zero_copy(self):
+        from bsread import source
+        from bsread.sender import sender
+        import numpy
+
+        test_array = numpy.arange(1024, dtype=numpy.float64)
+
+        with source(host="localhost", port=9999, copy=False) as in_stream:
+
+            with sender(queue_size=10) as stream:
+                stream.send(one=1, two=test_array, three="text")
+
+                message = in_stream.receive()
+
+                self.assertEqual(message.data.data["one"].value, 1)
+                self.assertEqual(message.data.data["three"].value, "text")
+
+                value = message.data.data["two"].value
+                numpy.testing.assert_array_equal(value, test_array)
+                self.assertFalse(value.flags.writeable)
+
+                detached_message = message.data.copy()
+                detached_value = detached_message.data["two"].value
+                numpy.testing.assert_array_equal(detached_value, test_array)
+                self.assertTrue(detached_value.flags.writeable)
+                self.assertTrue(detached_value.flags.owndata)
+
+    def test_receive_parallel_decode(self):
+        from bsread import source
+        from bsread.sender import sender
+        import numpy
+
+        # Large enough (also compressed) to be decoded on the thread pool.
+        send_data = {"image_%d" % index: numpy.random.randint(0, 2**16, size=(256, 512), dtype=numpy.uint16)
+                     for index in range(4)}
+        send_data["scalar"] = 1.0
+
+        with source(host="localhost", port=9999, decode_workers=2) as in_stream:
+
+            with sender(queue_size=10, data_compression="bitshuffle_lz4") as stream:
+                stream.send(data=send_data)
+
+                message = in_stream.receive()
+
+        for name, value in send_data.items():
+            numpy.testing.assert_array_equal(message.data.data[name].value, value)
+
+    def test_plan_cache(self):
+        from bsread import source
+        from bsread.sender import sender
+        from bsread.handlers.common import plan_cache
+
+        plan_cache.clear()
+
+        with source(host="localhost", port=9999) as in_stream:
+
+            with sender(queue_size=10) as stream:
+
+                # Alternate between two channel configurations.
+                for pulse_id in range(4):
+                    if pulse_id % 2 == 0:
+                        stream.send(pulse_id=pulse_id, one=1, two=2)
+                    else:
+                        stream.send(pulse_id=pulse_id, one=1, three=3.0)
+
+                    message = in_stream.receive()
+
+                    self.assertTrue(message.data.format_changed)
+                    self.assertEqual(message.data.pulse_id, pulse_id)
+                    self.assertEqual(message.data.data["one"].value, 1)
+
+        self.assertEqual(plan_cache.misses, 2)
+        self.assertEqual(plan_cache.hits, 2)
+
+    def test_plan_cache_data_header(self):
+        from bsread import source
+        from bsread.sender import sender
+        from bsread.handlers import extended
+        from bsread.handlers.common import plan_cache
+
+        plan_cache.clear()
+
+        with source(host="localhost", port=9999) as in_stream:
+            with sender(queue_size=10) as stream:
+                for _ in range(2):
+                    stream.send(one=1, two=2)
+
+                    # Modifying the received data header does not change the cached plan.
+                    message = in_stream.receive(handler=extended.Handler().receive)
+                    self.assertEqual(len(message.data["data_header"]["channels"]), 2)
+                    message.data["data_header"]["channels"].clear()
+
+        self.assertEqual(plan_cache.hits, 1)
+
+    def test_receive_projection(self):
+        from bsread import source
+        from bsread.sender import sender
+
+        with source(host="localhost", port=9999, projection=["two", "four"]) as in_stream:
+            with sender(queue_size=10) as stream:
+                stream.send(one=1, two=2, three=3, four=[4, 4])
+
+                message = in_stream.receive()
+                self.assertListEqual(list(message.data.data.keys()), ["two", "four"])
+                self.assertEqual(message.data.data["two"].value, 2)
+                self.assertListEqual(list(message.data.data["four"].value), [4, 4])
+
+        with source(host="localhost", port=9999, projection=lambda name: name.startswith("t")) as in_stream:
+            with sender(queue_size=10) as stream:
+                stream.send(one=1, two=2, three=3, four=[4, 4])
+                stream.send(one=1, two=2, three=3, four=[4, 4])
+
+                message = in_stream.receive()
+                self.assertListEqual(list(message.data.data.keys()), ["two", "three"])
+
+                batch = in_stream.receive_batch(1)
+                self.assertListEqual(list(batch.data.keys()), ["two", "three"])
+                self.assertEqual(batch.data["three"].value[0], 3)
+
+    def test_receive_lazy(self):
+        from bsread import source
+        from bsread.sender import sender
+        import numpy
+
+        with source(host="localhost", port=9999, lazy=True) as in_stream:
+            with sender(queue_size=10) as stream:
+                stream.send(one=1, two=None, three=numpy.arange(16, dtype=numpy.int32), timestamp=(123, 456))
+
+                message = in_stream.receive()
+
+                value = message.data.data["three"]
+                self.assertIsNotNone(value._reader)
+
+                numpy.testing.assert_array_equal(value.value, numpy.arange(16))
+                self.assertIsNone(value._reader)
+                self.assertIs(value.value, value.value)
+                self.assertEqual(value.timestamp, 123)
+                self.assertEqual(value.timestamp_offset, 456)
+
+                self.assertEqual(message.data.data["one"].value, 1)
+                self.assertIsNone(message.data.data["two"].value)
+                self.assertIsNone(message.data.data["two"].timestamp)
+
+    def test_decode_timestamps(self):
+        import struct
+        from bsread.handlers.common import decode_timestamps
+
+        raw_timestamps = [struct.pack("<qq", 1, 2),
+                          b"",
+                          struct.pack(">qq", 3, 4),
+                          None,
+                          struct.pack("<qqq", 5, 6, 7),
+                          struct.pack("<qq", 8, 9)]
+        endianness = ["<", "<", ">", "<", "<", "<"]
+
+        timestamps = decode_timestamps(raw_timestamps, endianness)
+
+        self.assertListEqual(timestamps, [(1, 2), (None, None), (3, 4), (None, None), (5, 6), (8, 9)])
+        self.assertIsInstance(timestamps[0][0], int)
+
+    def test_scalar_reader(self):
+        import numpy
+
+        for channel_type in ["int8", "uint8", "int16", "uint16", "int32", "uint32", "int64", "uint64",
+                             "float32", "float64", "bool"]:
+            for endianness in ["<", ">"]:
+                dtype = numpy.dtype(endianness + get_serialization_type(channel_type))
+                value_reader = get_value_reader(channel_type, None, shape=[1], endianness=endianness)
+                # Uncompressed scalars use the specialized reader.
+                self.assertEqual(value_reader.__name__, "scalar_reader")
+
+                result = value_reader(numpy.array([42], dtype=dtype).tobytes())
+                self.assertEqual(result, 42)
+                self.assertEqual(type(result), dtype.type)
+
+                # Without shape information two values are returned as array.
+                result = value_reader(numpy.array([1, 2], dtype=dtype).tobytes())
+                numpy.testing.assert_array_equal(result, [1, 2])
+
+                self.assertIsNone(value_reader(b""))
+
+        value_reader = get_value_reader("string", None, endianness="<")
+        self.assertEqual(value_reader.__name__, "string_reader")
+        self.assertEqual(value_reader("text ü".encode()), "text ü")
+        self.assertIsNone(value_reader(b""))
+        self.assertIsNone(value_reader(b"\xff"))
+
     def test_failed_conversion(self):
         channel_type = "int32"
         compression = None
@@ -93,5 +335,19 @@ class TestGenerator(unittest.TestCase):
         self.assertEqual(None, result)
 
 
+    def test_uncompressed_view(self):
+        import numpy
+
+        value_reader = get_value_reader("uint16", None, shape=[3, 2], endianness="<")
+
+        raw_data = bytearray(numpy.arange(6, dtype="<u2").tobytes())
+        value = value_reader(raw_data)
+
+        # Uncompressed values are read-only views on the received bytes - never copies.
+        numpy.testing.assert_array_equal(value, numpy.arange(6).reshape((2, 3)))
+        self.assertTrue(numpy.shares_memory(value, numpy.frombuffer(raw_data, dtype="u1")))
+        self.assertFalse(value.flags.writeable)
+
+
 if __name__ == '__main__':
     unittest.main()
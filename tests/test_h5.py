@@ -2,6 +2,7 @@ import unittest
 from threading import Thread
 
 import h5py
+import numpy
 import os
 from bsread import simulate, h5
 from bsread.h5 import process_message_compact
@@ -108,6 +109,61 @@ class TestWriter(unittest.TestCase):
         self.assertTrue("pulse_id" in file.keys())
         self.assertEqual(len(file["pulse_id"]), n_messages)
 
+    def test_receive_writer_thread(self):
+        n_messages = 20
+        generate_thread = Thread(target=generate_real_stream, args=(9999, n_messages,))
+        generate_thread.daemon = True
+        generate_thread.start()
+
+        source = "tcp://localhost:9999"
+
+        h5.receive(source, self.h5_test_filename, n_messages=n_messages, writer_queue_size=5)
+
+        generate_thread.join()
+
+        file = h5py.File(self.h5_test_filename)
+
+        for channel_name in (x["name"] for x in simulated_channels):
+            self.assertEqual(len(file[channel_name]["data"]), n_messages)
+
+        self.assertEqual(len(file["pulse_id"]), n_messages)
+
+    def test_receive_raw(self):
+        n_messages = 5
+        generate_thread = Thread(target=generate_compressed_stream, args=(9999, n_messages,))
+        generate_thread.setDaemon(True)
+        generate_thread.start()
+
+        source = "tcp://localhost:9999"
+
+        h5.receive(source, self.h5_test_filename, n_messages=n_messages, raw=True)
+
+        generate_thread.join()
+
+        file = h5py.File(self.h5_test_filename)
+
+        # Compressed chunks are written as received, one message per chunk.
+        self.assertEqual(file["IMAGE/data"].chunks, (1, 4, 8))
+        self.assertEqual(len(file["IMAGE/data"]), n_messages)
+
+        for image, pulse_id in zip(file["IMAGE/data"], file["IMAGE/pulse_id"]):
+            numpy.testing.assert_array_equal(image, numpy.full((4, 8), pulse_id, dtype="i4"))
+
+        self.assertListEqual([value.decode() for value in file["STRING/data"]],
+                             ["pulse %d" % pulse_id for pulse_id in file["STRING/pulse_id"]])
+
+
+def generate_compressed_stream(port, n_messages=None, interval=0.01):
+    from bsread.sender import Sender
+
+    generator = Sender(port=port, data_compression="bitshuffle_lz4")
+
+    generator.add_channel("IMAGE", lambda pulse_id: numpy.full((4, 8), pulse_id, dtype="i4"),
+                          metadata={"type": "int32", "shape": [8, 4]})
+    generator.add_channel("STRING", lambda pulse_id: "pulse %d" % pulse_id, metadata={"type": "string"})
+
+    generator.generate_stream(n_messages=n_messages, interval=interval)
+
 
 def generate_real_stream(port, n_messages=None, interval=0.01):
     from bsread.sender import Sender
@@ -0,0 +1,141 @@
+import time
+import unittest
+
+import zmq
+
+from bsread.handlers.compact import Message, Value
+from bsread.multi import MultiSource, PulseMerger
+from bsread.sender import sender
+
+
+class TestMultiSource(unittest.TestCase):
+
+    def test_receive(self):
+        sources = {"a": "tcp://localhost:9999", "b": "tcp://localhost:10000"}
+
+        with MultiSource(sources) as multi_source:
+            with sender(port=9999) as sender_a, sender(port=10000) as sender_b:
+
+                # Idle source "b" does not hold back source "a".
+                for index in range(3):
+                    sender_a.send(data={"A": index})
+
+                messages = [multi_source.receive(timeout=10) for _ in range(3)]
+                self.assertEqual([name for name, _ in messages], ["a"] * 3)
+                self.assertEqual([message.data.data["A"].value for _, message in messages], [0, 1, 2])
+
+                self.assertIsNone(multi_source.receive(timeout=0.1))
+
+                sender_b.send(data={"B": 1.0})
+                name, message = multi_source.receive(timeout=10)
+                self.assertEqual(name, "b")
+                self.assertEqual(message.data.data["B"].value, 1.0)
+
+    def test_skip_empty_messages(self):
+        socket = zmq.Context.instance().socket(zmq.PUSH)
+        socket.bind("tcp://*:9999")
+
+        try:
+            with MultiSource(["tcp://localhost:9999"]) as multi_source:
+                # Message with an empty header - decoded to None.
+                socket.send(b"{}")
+                self.assertIsNone(multi_source.receive(timeout=0.5))
+        finally:
+            socket.close(linger=0)
+
+    def test_fair_share(self):
+        sources = ["tcp://localhost:9999", "tcp://localhost:10000"]
+
+        with MultiSource(sources, max_messages_per_source=2) as multi_source:
+            with sender(port=9999) as sender_a, sender(port=10000) as sender_b:
+                for index in range(5):
+                    sender_a.send(data={"A": index})
+                sender_b.send(data={"B": 0})
+
+                # Make sure all messages arrived.
+                time.sleep(0.5)
+
+                names = []
+                while len(names) < 6:
+                    names.extend(name for name, _ in multi_source.poll(timeout=10))
+
+        # At most 2 messages of the first source before the second source gets its turn.
+        self.assertEqual(names.count(sources[0]), 5)
+        self.assertLess(names.index(sources[1]), 3)
+
+    def test_pulse_merger(self):
+        merger = PulseMerger(["a", "b"], window=3, timeout=0.1)
+
+        def message(pulse_id, name):
+            return Message(pulse_id=pulse_id, data={name: Value(pulse_id)})
+
+        self.assertEqual(merger.add("a", message(1, "A")), [])
+        self.assertEqual(merger.add("a", message(2, "A")), [])
+
+        # Pulse 2 complete - pulse 1 cannot complete anymore.
+        merged = merger.add("b", message(2, "B"))
+        self.assertEqual([m.pulse_id for m in merged], [1, 2])
+        self.assertFalse(merged[0].complete)
+        self.assertTrue(merged[1].complete)
+        self.assertIsNone(merged[0].get_message("b"))
+        self.assertEqual(list(merged[1].data.keys()), ["A", "B"])
+
+        # Late message.
+        self.assertEqual(merger.add("b", message(1, "B")), [])
+
+        # Window full - the oldest pulse is emitted.
+        for pulse_id in range(3, 7):
+            merged = merger.add("a", message(pulse_id, "A"))
+        self.assertEqual([m.pulse_id for m in merged], [3])
+
+        # Timeout.
+        time.sleep(0.2)
+        self.assertEqual([m.pulse_id for m in merger.flush()], [4, 5, 6])
+
+        self.assertEqual(merger.statistics.complete_pulses, 1)
+        self.assertEqual(merger.statistics.incomplete_pulses, 5)
+        self.assertEqual(merger.statistics.late_messages, 1)
+        self.assertEqual(merger.statistics.missing_messages, {"a": 0, "b": 5})
+
+    def test_receive_merged(self):
+        sources = {"a": "tcp://localhost:9999", "b": "tcp://localhost:10000"}
+
+        with MultiSource(sources) as multi_source:
+            with sender(port=9999) as sender_a, sender(port=10000) as sender_b:
+                for pulse_id in range(10, 13):
+                    sender_b.send(pulse_id=pulse_id, data={"B": pulse_id})
+                    sender_a.send(pulse_id=pulse_id, data={"A": pulse_id})
+
+                merged_messages = multi_source.receive_merged(timeout=10)
+                merged = [next(merged_messages) for _ in range(3)]
+
+        self.assertEqual([m.pulse_id for m in merged], [10, 11, 12])
+        self.assertTrue(all(m.complete for m in merged))
+        self.assertEqual([m.data["B"].value for m in merged], [10, 11, 12])
+
+    def test_receive_merged_empty_messages(self):
+        sources = {"a": "tcp://localhost:9999", "b": "tcp://localhost:10000"}
+
+        socket_b = zmq.Context.instance().socket(zmq.PUSH)
+        socket_b.bind("tcp://*:10000")
+
+        try:
+            with MultiSource(sources) as multi_source:
+                with sender(port=9999) as sender_a:
+                    # Empty message of source "b" - not passed to the merger.
+                    socket_b.send(b"{}")
+
+                    for pulse_id in range(10, 13):
+                        sender_a.send(pulse_id=pulse_id, data={"A": pulse_id})
+
+                    merged_messages = multi_source.receive_merged(timeout=0.2)
+                    merged = [next(merged_messages) for _ in range(3)]
+        finally:
+            socket_b.close(linger=0)
+
+        self.assertEqual([m.pulse_id for m in merged], [10, 11, 12])
+        self.assertTrue(all(m.get_message("b") is None for m in merged))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+import numpy
+
+from bsread.parallel import ParallelSource
+from bsread.sender import sender
+
+
+class TestParallelSource(unittest.TestCase):
+
+    def test_receive_ordered(self):
+        image = numpy.arange(256 * 256, dtype="u2").reshape((256, 256))
+
+        with ParallelSource(host="localhost", port=9999, n_workers=2, ordered=True) as receive_stream:
+            with sender(port=9999) as send_stream:
+                for index in range(10):
+                    send_stream.send(data={"image": image + index, "scalar": index})
+
+                messages = [receive_stream.receive(timeout=30) for _ in range(10)]
+
+        self.assertEqual([message.data.pulse_id for message in messages], list(range(10)))
+        self.assertEqual([message.data.data["scalar"].value for message in messages], list(range(10)))
+        numpy.testing.assert_array_equal(messages[5].data.data["image"].value, image + 5)
+        # Large arrays are views on the shared memory, not copies
+        self.assertFalse(messages[5].data.data["image"].value.flags.owndata)
+        self.assertEqual(receive_stream.statistics.messages_received, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ import bsread.data.helpers
 import bsread.sender
 
 from bsread.data.helpers import get_channel_specs, get_serialization_type
+from bsread.data.serialization import compression_provider_mapping
 from bsread.sender import sender
 from bsread import source
 
@@ -369,6 +370,120 @@ class TestGenerator(unittest.TestCase):
         self.assertTrue(bool(boolean_type))
         numpy.testing.assert_array_equal(send_boolean_array, boolean_type_array)
 
+    def test_send_zero_copy(self):
+        send_data = {"image": numpy.arange(256 * 256, dtype=">u2").reshape((256, 256)),  # Above the zmq copy threshold.
+                     "transposed": numpy.arange(64 * 32, dtype="f8").reshape((64, 32)).T,
+                     "scalar": 1,
+                     "empty": None}
+
+        image = send_data["image"].copy()
+
+        with source(host="localhost") as receive_stream:
+            with sender(copy=False) as send_stream:
+                send_stream.send(data=send_data)
+
+                # Without reference_values the sent arrays are copied - modifying them does not change the message.
+                send_data["image"][:] = 0
+
+                received_message = receive_stream.receive()
+
+        numpy.testing.assert_array_equal(image, received_message.data.data["image"].value)
+        numpy.testing.assert_array_equal(send_data["transposed"], received_message.data.data["transposed"].value)
+        self.assertEqual(received_message.data.data["scalar"].value, 1)
+        self.assertIsNone(received_message.data.data["empty"].value)
+
+        # With reference_values the arrays are sent without any copy.
+        with source(host="localhost") as receive_stream:
+            with sender(copy=False, reference_values=True) as send_stream:
+                send_stream.send(data=send_data)
+                received_message = receive_stream.receive()
+
+        numpy.testing.assert_array_equal(send_data["transposed"], received_message.data.data["transposed"].value)
+        numpy.testing.assert_array_equal(send_data["image"], received_message.data.data["image"].value)
+
+    def test_send_parallel_compression(self):
+        send_data = {"image_%d" % index: numpy.random.randint(0, 4096, size=(128, 128), dtype="u2")
+                     for index in range(4)}
+        send_data["scalar"] = 1.0
+
+        with source(host="localhost") as receive_stream:
+            with sender(data_compression="bitshuffle_lz4", compression_workers=2,
+                        compression_threshold=0) as send_stream:
+                send_stream.send(data=send_data)
+                self.assertIsNotNone(send_stream.compression_executor)
+
+                received_message = receive_stream.receive()
+
+            self.assertIsNone(send_stream.compression_executor)
+
+        self.assertEqual(list(received_message.data.data.keys()), list(send_data.keys()))
+        for name in send_data:
+            numpy.testing.assert_array_equal(send_data[name], received_message.data.data[name].value)
+
+    def test_compression_tuning(self):
+        send_data = {"image": numpy.arange(256 * 256, dtype="u2").reshape((256, 256)),
+                     "noise": numpy.random.randint(0, 2 ** 32, size=4096, dtype="u4").view("f4"),
+                     "scalar": 1.0}
+
+        with source(host="localhost") as receive_stream:
+            with sender(data_compression="bitshuffle_lz4") as send_stream:
+                send_stream.tune_compression(send_data)
+
+                image_metadata = send_stream.channels["image"].metadata
+                self.assertEqual(image_metadata["compression"], "bitshuffle_lz4")
+                self.assertIn(image_metadata["compression_block_size"], [128, 1024, 2048, 4096, 8192, 16384, 32768])
+
+                # Compression does not pay off on noise.
+                self.assertEqual(send_stream.channels["noise"].metadata["compression"], "none")
+                self.assertNotIn("compression_block_size", send_stream.channels["scalar"].metadata)
+
+                data_header_bytes = send_stream.data_header_bytes
+                send_stream.send(data=send_data)
+                self.assertIs(data_header_bytes, send_stream.data_header_bytes)
+
+                received_message = receive_stream.receive()
+
+        for name in send_data:
+            numpy.testing.assert_array_equal(send_data[name], received_message.data.data[name].value)
+
+    def test_compression_providers(self):
+        send_data = {"image": numpy.arange(64 * 32, dtype=">u2").reshape((32, 64)),
+                     "waveform": numpy.random.rand(1024),
+                     "string": "compressed string",
+                     "scalar": 1}
+
+        for compression in [name for name in compression_provider_mapping if name not in (None, "none")]:
+            with source(host="localhost") as receive_stream:
+                with sender(data_compression=compression) as send_stream:
+                    send_stream.send(data=send_data)
+                    received_message = receive_stream.receive()
+
+            self.assertEqual(received_message.data.data["string"].value, send_data["string"])
+            for name in ["image", "waveform", "scalar"]:
+                numpy.testing.assert_array_equal(send_data[name], received_message.data.data[name].value,
+                                                 err_msg=compression)
+
+    def test_send_cached_data_header(self):
+        with source(host="localhost") as receive_stream:
+            with sender() as send_stream:
+                send_stream.send(data={"scalar": 1.0, "array": numpy.zeros(16, dtype="i2")})
+                data_header_bytes = send_stream.data_header_bytes
+
+                # Same types and shapes - data header is not recreated.
+                send_stream.send(data={"scalar": 2.0, "array": numpy.ones(16, dtype="i2")})
+                self.assertIs(data_header_bytes, send_stream.data_header_bytes)
+
+                # Changed shape - data header is recreated.
+                send_stream.send(data={"scalar": 3.0, "array": numpy.ones(8, dtype="i2")})
+                self.assertIsNot(data_header_bytes, send_stream.data_header_bytes)
+                self.assertEqual(send_stream.channels["array"].metadata["shape"], [8])
+
+                messages = [receive_stream.receive() for _ in range(3)]
+
+        self.assertEqual([message.data.data["scalar"].value for message in messages], [1.0, 2.0, 3.0])
+        numpy.testing.assert_array_equal(messages[1].data.data["array"].value, numpy.ones(16, dtype="i2"))
+        numpy.testing.assert_array_equal(messages[2].data.data["array"].value, numpy.ones(8, dtype="i2"))
+
 
 
 if __name__ == '__main_ _':
@@ -3,8 +3,10 @@ import unittest
 import os
 
 import h5py
+import numpy
 
-from bsread.writer import Writer
+from bsread.data.compression import BitshuffleLZ4
+from bsread.writer import Writer, WriterThread, COMPRESSIONS, get_chunk_shape
 
 
 class TestWriter(unittest.TestCase):
@@ -161,3 +163,171 @@ class TestWriter(unittest.TestCase):
         self.assertListEqual(list(replaced_dataset_3), [0] * 50)
 
         file.close()
+
+    def test_buffered_write(self):
+        writer = Writer(buffer_size=32)
+
+        writer.open_file(self.TEST_FILENAME)
+
+        writer.add_dataset("/test/data")
+        writer.add_dataset("/test/image", shape=(1, 4, 8), maxshape=(None, 4, 8), dtype="u2")
+        writer.add_dataset("/test/string", dtype=h5py.special_dtype(vlen=str))
+        writer.add_dataset_stub(dataset_name="/test/data2")
+
+        for number in range(0, 50):
+            writer.write([number, numpy.full((4, 8), number, dtype="u2"), str(number) if number % 2 else None, None])
+
+        # Rows are collected before they are written.
+        self.assertGreater(writer.dataset_groups["data"].datasets[0].buffer_count, 0)
+        # A buffer smaller than a chunk (1000 rows) is not rounded up.
+        self.assertEqual(len(writer.dataset_groups["data"].datasets[0].buffer), 32)
+
+        writer.replace_dataset(dataset_name="/test/data2")
+
+        for number in range(50, 100):
+            writer.write([number, numpy.full((4, 8), number, dtype="u2"), str(number) if number % 2 else None, number])
+
+        writer.close_file()
+
+        file = h5py.File(self.TEST_FILENAME)
+
+        self.assertListEqual(list(file["/test/data"]), list(range(100)))
+        self.assertEqual(file["/test/image"].shape, (100, 4, 8))
+        self.assertListEqual([int(image[3, 7]) for image in file["/test/image"]], list(range(100)))
+        self.assertListEqual([value.decode() for value in file["/test/string"][:4]], ["", "1", "", "3"])
+        self.assertListEqual(list(file["/test/data2"]), [0] * 50 + list(range(50, 100)))
+
+        file.close()
+
+
+    def test_compression(self):
+        for compression in COMPRESSIONS:
+            writer = Writer(compression=compression, shuffle=True, rate=10)
+
+            writer.open_file(self.TEST_FILENAME)
+
+            writer.add_dataset("/test/data")
+            writer.add_dataset("/test/image", shape=(1, 64, 64), maxshape=(None, 64, 64), dtype="u2")
+            writer.add_dataset("/test/string", dtype=h5py.special_dtype(vlen=str))
+
+            for number in range(0, 25):
+                writer.write([number, numpy.full((64, 64), number, dtype="u2"), str(number)])
+
+            writer.close_file()
+
+            file = h5py.File(self.TEST_FILENAME)
+
+            # One second of data per chunk.
+            self.assertEqual(file["/test/data"].chunks, (10,))
+            self.assertEqual(file["/test/image"].chunks, (10, 64, 64))
+            self.assertIsNotNone(file["/test/image"].compression)
+
+            self.assertListEqual(list(file["/test/data"]), list(range(25)))
+            self.assertListEqual([int(image[63, 63]) for image in file["/test/image"]], list(range(25)))
+            self.assertListEqual([value.decode() for value in file["/test/string"]], [str(x) for x in range(25)])
+
+            file.close()
+
+    def test_chunk_shape(self):
+        self.assertEqual(get_chunk_shape((1, 64, 64), "u2", rate=10), (10, 64, 64))
+        self.assertEqual(get_chunk_shape((1, 1024, 1024), "u2", rate=10), (1, 1024, 1024))
+        # Rows without data.
+        self.assertEqual(get_chunk_shape((1, 0), "f8", rate=10), (1, 0))
+
+    def test_direct_chunk_write(self):
+        writer = Writer()
+
+        writer.open_file(self.TEST_FILENAME)
+        writer.add_dataset("/test/image", shape=(1, 16, 32), maxshape=(None, 16, 32), dtype="u2", direct_chunk=True)
+
+        for number in range(0, 10):
+            image = numpy.full((16, 32), number, dtype="u2")
+            writer.write([BitshuffleLZ4.pack_data(image, "u2") if number != 5 else None])
+
+        # Chunk of the wrong size.
+        writer.write([BitshuffleLZ4.pack_data(numpy.zeros(8, dtype="u2"), "u2")])
+
+        writer.close_file()
+
+        file = h5py.File(self.TEST_FILENAME)
+
+        self.assertEqual(file["/test/image"].shape, (11, 16, 32))
+        self.assertEqual(file["/test/image"].chunks, (1, 16, 32))
+        self.assertListEqual([int(image[15, 31]) for image in file["/test/image"]],
+                             [0, 1, 2, 3, 4, 0, 6, 7, 8, 9, 0])
+
+        file.close()
+
+    def test_writer_thread(self):
+        writer = WriterThread(Writer(), queue_size=10).start()
+
+        writer.open_file(self.TEST_FILENAME)
+        writer.add_dataset("/test/data")
+        writer.add_dataset("/test/pulse_id", dataset_group_name="pulse_id")
+
+        for number in range(0, 100):
+            writer.write([number])
+            writer.write([number], dataset_group_name="pulse_id")
+            writer.end_message()
+
+        writer.close_file()
+
+        self.assertLessEqual(writer.max_queue_depth, 10)
+        self.assertEqual(writer.messages_dropped, 0)
+
+        file = h5py.File(self.TEST_FILENAME)
+
+        # Compacted on close.
+        self.assertListEqual(list(file["/test/data"]), list(range(100)))
+        self.assertListEqual(list(file["/test/pulse_id"]), list(range(100)))
+
+        file.close()
+
+    def test_writer_thread_error(self):
+        writer = WriterThread(Writer(), queue_size=10).start()
+
+        writer.open_file(self.TEST_FILENAME)
+        writer.add_dataset("/test/data")
+        writer.write([1, 2])
+
+        # The error of the writer thread is raised in the caller.
+        self.assertRaises(RuntimeError, writer.close_file)
+
+    def test_dataset_growth(self):
+        writer = Writer()
+
+        writer.open_file(self.TEST_FILENAME)
+        writer.add_dataset("/test/data")
+
+        for number in range(0, 1002):
+            writer.write([number])
+
+        # Geometric growth - 1001 rows after the first resize, then doubled.
+        self.assertEqual(writer.dataset_groups["data"].datasets[0].reference.shape, (2002,))
+
+        writer.close_file()
+
+        file = h5py.File(self.TEST_FILENAME)
+        self.assertListEqual(list(file["/test/data"]), list(range(1002)))
+        file.close()
+
+    def test_expected_messages(self):
+        writer = Writer(expected_messages=5000)
+
+        writer.open_file(self.TEST_FILENAME)
+        writer.add_dataset("/test/data")
+        writer.add_dataset("/test/image", shape=(1, 4, 8), maxshape=(None, 4, 8), dtype="u2")
+
+        # Preallocated up front.
+        self.assertEqual(writer.dataset_groups["data"].datasets[0].reference.shape, (5000,))
+        self.assertEqual(writer.dataset_groups["data"].datasets[1].reference.shape, (5000, 4, 8))
+
+        for number in range(0, 100):
+            writer.write([number, numpy.full((4, 8), number, dtype="u2")])
+
+        writer.close_file()
+
+        file = h5py.File(self.TEST_FILENAME)
+        self.assertListEqual(list(file["/test/data"]), list(range(100)))
+        self.assertEqual(file["/test/image"].shape, (100, 4, 8))
+        file.close()